@@ -1,31 +1,106 @@
 from enum import Enum
 from numbers import Number
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from ccompiler.tokens import Token
 from abc import abstractmethod, ABC
 from collections import OrderedDict
 from string import Template
 
 
-class Scope(dict):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+class Scope:
+    """Variables of a block, nested in the scope of the enclosing block.
+
+    A child scope does not copy the variables of its parent. All scopes of a program share
+    one MaxOffset and one table of the addresses of every identifier, innermost last, and
+    the chain of scopes from the outermost to the one that was created last. Creating a
+    scope cuts the chain at its parent, so the variables of scopes that were closed before
+    drop out of the table as they are met. This needs the scopes to be created and used in
+    the order of a depth first walk, which is how the nodes are emitted.
+    """
+    __slots__ = ("depth", "variables", "offset", "max_offset", "bindings", "chain")
+    def __init__(self, parent: "Scope" = None, max_offset: "MaxOffset" = None):
+        self.variables = {}
         self.offset = 0
-        self.max_offset = kwargs.get("max_offset", MaxOffset())
+        if parent is None:
+            self.depth = 0
+            self.max_offset = MaxOffset() if max_offset is None else max_offset
+            self.bindings: dict[str, list[tuple[Scope, int]]] = {}
+            self.chain = [self]
+        else:
+            self.depth = parent.depth + 1
+            self.max_offset = parent.max_offset if max_offset is None else max_offset
+            self.bindings, self.chain = parent.bindings, parent.chain
+            del self.chain[self.depth:]
+            self.chain.append(self)
+    def lookup(self, identifier: str) -> int | None:
+        if (bindings:=self.bindings.get(identifier)) is None: return None
+        chain = self.chain
+        # the scope of the last binding was closed
+        while bindings and ((scope:=bindings[-1][0]).depth >= len(chain) or chain[scope.depth] is not scope):
+            bindings.pop()
+        for scope, address in reversed(bindings):
+            if scope.depth <= self.depth and chain[scope.depth] is scope: return address
+        return None
     def create_var(self, identifier: str, size: int = 8) -> int:
         """address is offset from stack pointer"""
         # early return if variable was defined before
-        if identifier in self: return self[identifier]
-        self[identifier] = self.offset
+        if (address:=self.lookup(identifier)) is not None: return address
+        address = self.variables[identifier] = self.offset
+        self.bindings.setdefault(identifier, []).append((self, address))
         self.offset += size
         self.max_offset.check(self.offset)
-        return self[identifier]
-    def __getitem__(self, key):
-        if key not in self:
-            raise Exception(f"Variable '{key}' not found")
-        return super().__getitem__(key)
+        return address
+    def __getitem__(self, identifier: str) -> int:
+        if (address:=self.lookup(identifier)) is None:
+            raise Exception(f"Variable '{identifier}' not found")
+        return address
+    def __contains__(self, identifier: str) -> bool:
+        return self.lookup(identifier) is not None
+    def items(self) -> list[tuple[str, int]]:
+        """the variables visible in the scope"""
+        visible = {}
+        for scope in self.chain[:self.depth + 1]:
+            visible.update(scope.variables)
+        return list(visible.items())
     def create_child(self):
-        return Scope(self, max_offset=self.max_offset)
+        return Scope(self)
+
+class CodeWriter:
+    """Instructions written to a text file in chunks, one per line.
+
+    It stands in for the list of instructions of `AstNode.emit`. Appending None reserves a
+    line that is filled in later through `writer[index] = line`, only the lines before the
+    first reserved one are written. `append` and `extend` are the ones of the list of lines
+    that were not written yet, so emitting costs the same as into a list.
+    """
+    CHUNK = 4096
+    def __init__(self, file):
+        self.file = file
+        # lines written to the file so far
+        self.written = 0
+        self.lines: list[str | None] = []
+        self.append = self.lines.append
+        self.extend = self.lines.extend
+    def __len__(self):
+        return self.written + len(self.lines)
+    def __setitem__(self, index: int, line: str):
+        self.lines[index - self.written] = line
+        self.spill()
+    def spill(self):
+        """flush once a chunk of lines came together"""
+        if len(self.lines) >= self.CHUNK: self.flush()
+    def flush(self):
+        """write the lines up to the first reserved one"""
+        lines = self.lines
+        try:
+            ready = lines.index(None)
+        except ValueError:
+            ready = len(lines)
+        if not ready: return
+        # lines are separated, there is no newline behind the last one
+        self.file.write(("\n" if self.written else "") + "\n".join(lines[:ready]))
+        self.written += ready
+        del lines[:ready]
 
 class Program(ABC):
     header: list[str]
@@ -41,6 +116,42 @@ class Program(ABC):
         o = cls()
         o.code = ast.emit(Scope())
         return o
+    
+    @classmethod
+    def build_stream(cls, nodes):
+        """same program as `build(Top(Block(nodes)))`, emits every node as soon as it arrives"""
+        o = cls()
+        scope = Scope().create_child()
+        for node in nodes:
+            node.emit(scope, o.code)
+        return o
+    
+    @classmethod
+    def write(cls, ast, file):
+        """write the program of ast to file while it is emitted, the same text as `str(build(ast))`"""
+        if isinstance(ast, Top):
+            cls.write_stream(ast.body, file)
+        else:
+            cls._write(file, lambda writer: ast.emit(Scope(), writer))
+    
+    @classmethod
+    def write_stream(cls, nodes, file):
+        """write the program of the nodes to file, every node as soon as it arrives"""
+        def emit(writer: CodeWriter):
+            scope = Scope().create_child()
+            for node in nodes:
+                node.emit(scope, writer)
+                writer.spill()
+        cls._write(file, emit)
+    
+    @classmethod
+    def _write(cls, file, emit):
+        o = cls()
+        writer = CodeWriter(file)
+        writer.extend(o.header)
+        emit(writer)
+        writer.extend(o.text)
+        writer.flush()
         
     
     def create_local_var(self, identifier: str, size: int = 8) -> int:
@@ -72,6 +183,7 @@ class Arm64Program(Program):
 
 class MaxOffset:
     value: int
+    __slots__ = ("value",)
     def __init__(self):
         self.value = 0
     def check(self, value: int):
@@ -90,74 +202,85 @@ class Float(Type):
     size = 4
     
 
-@dataclass
+# nodes have slots instead of a __dict__, a large source has a lot of them
+@dataclass(slots=True)
 class AstNode(ABC):
-    def emit(self, scope: Scope): 
+    def emit(self, scope: Scope, code: list[str] = None) -> list[str]:
+        """instructions of the node, emitted on an explicit stack instead of recursively,
+        appended to code if it is given, e.g. a CodeWriter"""
+        code = [] if code is None else code
+        stack = [iter(self.steps(scope, code))]
+        while stack:
+            if (child:=next(stack[-1], None)) is None:
+                stack.pop()
+                continue
+            node, scope = child
+            stack.append(iter(node.steps(scope, code)))
+        return code
+    def steps(self, scope: Scope, code: list[str]):
+        """append the instructions of the node to code, returns the (child, scope) pairs to emit in between"""
         raise NotImplementedError(f"emit not implemented for {self.__class__.__name__}")
     
 class Block(list, AstNode):
-    def emit(self, scope: Scope):
+    __slots__ = ()
+    def steps(self, scope: Scope, code: list[str]):
         scope = scope.create_child()
-        inner = [instruction for sublist in map(lambda x: x.emit(scope), self) for instruction in sublist]
-        return inner
+        for node in self:
+            yield node, scope
 
-@dataclass
+@dataclass(slots=True)
 class Top(AstNode):
     body: Block
-    def emit(self, scope: Scope):
-        inner = self.body.emit(scope)
-        return inner
+    def steps(self, scope: Scope, code: list[str]):
+        yield self.body, scope
         
 
-@dataclass
+@dataclass(slots=True)
 class Variable(AstNode):
     identifier: str
-    def emit(self, scope: Scope):
-        return [
-            f"ldr w8, [sp, #{scope[self.identifier]}]"
-        ]
+    def steps(self, scope: Scope, code: list[str]):
+        code.append(f"ldr w8, [sp, #{scope[self.identifier]}]")
+        return ()
     
-@dataclass
+@dataclass(slots=True)
 class Immidiate(AstNode):
     type_identifier: Token
     value: Number
-    def emit(self, scope: Scope):
-        return [
-            f"mov w8, #{self.value}",
-        ]
+    def steps(self, scope: Scope, code: list[str]):
+        code.append(f"mov w8, #{self.value}")
+        return ()
         
 
-@dataclass
+@dataclass(slots=True)
 class Function(AstNode):
     return_type: Token
     identifier: str
     parameter_list: list
     body: Block
-    def emit(self, scope: Scope):
-        inner = self.body.emit(scope)
+    def steps(self, scope: Scope, code: list[str]):
+        code.append(f"_{self.identifier}:")
+        header = len(code)
+        code.append(None)
+        yield self.body, scope
         stack_size = scope.max_offset.value
         # now we know the stack size and can add it to the scope
         # TODO: variables on stack or reversed in comparison to standard.
-        return [
-            f"_{self.identifier}:",
-            f"sub sp, sp, #{stack_size}", # TODO: Does this have to be aligned by 16?
-            *inner
-        ]
+        code[header] = f"sub sp, sp, #{stack_size}" # TODO: Does this have to be aligned by 16?
 
-@dataclass
+@dataclass(slots=True)
 class EmptyStatement(AstNode):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class Expression(AstNode):
     pass
 
-@dataclass
+@dataclass(slots=True)
 class UnaryOp(AstNode):
     operator: Token
     expression: Expression
 
-@dataclass
+@dataclass(slots=True)
 class BinaryOp(AstNode):
     left: Expression
     operator: Token
@@ -167,52 +290,74 @@ class BinaryOp(AstNode):
         Token.MINUS: "sub",
         Token.STAR: "mul",
         Token.SLASH: "sdiv",
-        Token.PERCENT: "srem",
     }
         
-    def emit(self, scope: Scope):
-        return [
-            *self.left.emit(scope),
-            "mov w9, w8",
-            *self.right.emit(scope),
-            f"{self._operator_map[self.operator]} w8, w9, w8"
-        ]
+    def steps(self, scope: Scope, code: list[str]):
+        yield self.left, scope
+        code.append("mov w9, w8")
+        yield self.right, scope
+        if self.operator == Token.PERCENT:
+            # there is no remainder instruction, it is w9 - w9 / w8 * w8
+            code.append("sdiv w10, w9, w8")
+            code.append("msub w8, w10, w8, w9")
+        else:
+            code.append(f"{self._operator_map[self.operator]} w8, w9, w8")
 
-@dataclass
+@dataclass(slots=True)
 class Return(AstNode):
     expression: Expression
-    def emit(self, scope: Scope):
-        return [
-            *self.expression.emit(scope),
-            "mov w0, w8",
-            f"add sp, sp, #{scope.max_offset.value}",
-            "ret"
-        ]
+    def steps(self, scope: Scope, code: list[str]):
+        yield self.expression, scope
+        code.append("mov w0, w8")
+        code.append(f"add sp, sp, #{scope.max_offset.value}")
+        code.append("ret")
 
-@dataclass
+@dataclass(slots=True)
 class Assignment(AstNode):
     identifier: str
     expression: Expression
-    def emit(self, scope: Scope):
-        return [
-            *self.expression.emit(scope),
-            f"str w8, [sp, #{scope[self.identifier]}]"
-        ]
+    def steps(self, scope: Scope, code: list[str]):
+        yield self.expression, scope
+        code.append(f"str w8, [sp, #{scope[self.identifier]}]")
 
-@dataclass
+@dataclass(slots=True)
 class Definition(AstNode):
     type_identifier: Token
     identifier: str
     expression: Expression = None
-    def emit(self, scope: Scope):
+    def steps(self, scope: Scope, code: list[str]):
         address = scope.create_var(self.identifier)
-        if self.expression is None: return []
-        return [
-            *self.expression.emit(scope),
-            f"str w8, [sp, #{address}]"
-        ]
+        if self.expression is None: return
+        yield self.expression, scope
+        code.append(f"str w8, [sp, #{address}]")
 
-@dataclass
+@dataclass(slots=True)
 class Parameter(AstNode):
     type_identifier: Token
-    identifier: str
\ No newline at end of file
+    identifier: str
+
+def outline(node) -> str:
+    """the tree under node, a line per node indented by its depth, written without recursion
+    so that it shows trees of any depth"""
+    lines = []
+    stack = [(node, 0, "")]
+    while stack:
+        node, depth, label = stack.pop()
+        children = []
+        if isinstance(node, list):
+            line = type(node).__name__
+            children = [(child, "") for child in node]
+        elif isinstance(node, AstNode):
+            values = []
+            for field in fields(node):
+                value = getattr(node, field.name)
+                if isinstance(value, (AstNode, list)):
+                    children.append((value, f"{field.name}="))
+                else:
+                    values.append(f"{field.name}={value.__name__ if isinstance(value, type) else value if isinstance(value, Enum) else repr(value)}")
+            line = f"{type(node).__name__}({', '.join(values)})"
+        else:
+            line = repr(node)
+        lines.append("  " * depth + label + line)
+        stack.extend((child, depth + 1, label) for child, label in reversed(children))
+    return "\n".join(lines)
@@ -0,0 +1,94 @@
+import os
+import sys
+from time import perf_counter
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from ccompiler.compiler import Compilation, specialized
+from ccompiler.server import compile_request
+
+@dataclass
+class Unit:
+    """A translation unit of a batch, the assembly is written to `output`."""
+    path: str
+    output: str
+    compilation: Compilation = None
+    # seconds from reading the file to its assembly, in the worker
+    elapsed: float = 0.0
+    @property
+    def failed(self) -> bool:
+        # a source with errors still has the assembly of the part that parsed
+        return self.compilation.assembly is None or bool(self.compilation.diagnostics)
+
+def manifest(path: str) -> list[str]:
+    """the inputs listed one per line in a manifest, relative to it, # starts a comment"""
+    directory = os.path.dirname(path)
+    with open(path) as file:
+        lines = (line.split("#", 1)[0].strip() for line in file)
+        return [os.path.join(directory, line) for line in lines if line]
+
+def _compile(path: str) -> tuple[Compilation, float]:
+    start = perf_counter()
+    try:
+        compilation = compile_request({"path": path})
+    except Exception as error:
+        compilation = Compilation(None, [f"error: {error}"], {})
+    return compilation, perf_counter() - start
+
+def outputs(paths: list[str], directory: str = None) -> list[str]:
+    """where the assembly of the files goes, next to them or into directory, where they keep
+    their paths relative to the directory all of them are in"""
+    if directory is None: return [os.path.splitext(path)[0] + ".s" for path in paths]
+    common = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths]) if paths else ""
+    return [os.path.join(directory, os.path.splitext(os.path.relpath(os.path.abspath(path), common))[0] + ".s") for path in paths]
+
+def prepare(paths: list[str], outputs: list[str]) -> list[str]:
+    """the outputs, once their directories exist, ValueError if two files would go to the same one"""
+    seen = {}
+    for path, output in zip(paths, outputs):
+        if (other:=seen.setdefault(os.path.abspath(output), path)) != path:
+            raise ValueError(f"{other} and {path} would both be compiled to {output}")
+    for output in {os.path.dirname(output) for output in outputs}:
+        if output: os.makedirs(output, exist_ok=True)
+    return outputs
+
+def compile_batch(paths: list[str], directory: str = None, workers: int = None) -> list[Unit]:
+    """Compile the files on a pool of processes and write their assembly next to them, or into directory.
+
+    Every worker specializes the grammar once and keeps it for all the files it gets. The
+    assembly is written in the order of the paths, a file that fails does not stop the others.
+    """
+    units = [Unit(path, output) for path, output in zip(paths, prepare(paths, outputs(paths, directory)))]
+    with ProcessPoolExecutor(workers, initializer=specialized) as executor:
+        for unit, (unit.compilation, unit.elapsed) in zip(units, executor.map(_compile, paths)):
+            if unit.failed: continue
+            with open(unit.output, "w") as file:
+                file.write(unit.compilation.assembly)
+    return units
+
+def summary(units: list[Unit], elapsed: float) -> str:
+    lines = []
+    for unit in units:
+        timings = " ".join(f"{stage} {time * 1000:.2f} ms" for stage, time in unit.compilation.timings.items())
+        lines.append(f"{'FAILED' if unit.failed else 'ok':<7}{unit.path}: {unit.elapsed * 1000:.2f} ms ({timings})")
+        lines.extend(f"    {diagnostic}" for diagnostic in unit.compilation.diagnostics)
+    failed = sum(unit.failed for unit in units)
+    lines.append(f"{len(units)} files, {failed} failed, in {elapsed * 1000:.0f} ms ({len(units) / elapsed:.1f} files/s)")
+    return "\n".join(lines)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--manifest", type=str, action="append", default=[])
+    parser.add_argument("-j", "--jobs", type=int)
+    parser.add_argument("-d", "--directory", type=str)
+    parser.add_argument("inputs", nargs="*")
+    args = parser.parse_args()
+    paths = [*args.inputs, *(path for manifest_path in args.manifest for path in manifest(manifest_path))]
+    assert paths, "Either inputs or a manifest must be provided"
+    start = perf_counter()
+    units = compile_batch(paths, args.directory, args.jobs)
+    print(summary(units, perf_counter() - start))
+    if any(unit.failed for unit in units): sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import json
+import tempfile
+import hashlib
+from time import perf_counter
+from functools import cache
+from ccompiler.tokens import Token
+from ccompiler.parsers import Source
+from ccompiler.ast import Arm64Program, Scope, Function
+from ccompiler.compiler import Compilation, diagnostics, grammar, version, cache_directory
+
+class FunctionCache:
+    """Assembly of top level functions on disk, under a hash of everything it depends on.
+
+    Every entry is a file of its own that is written under another name first and then
+    renamed, so readers never see half an entry. Reading an entry touches it, once the
+    entries take more than `size` bytes the ones that were not used for the longest are
+    removed.
+    """
+    directory: str
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+    def __init__(self, directory: str = None, size: int = 64 << 20):
+        self.directory = directory or os.path.join(cache_directory(), "functions")
+        self.size = size
+        self.hits = self.misses = self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self.used = sum(entry.stat().st_size for entry in os.scandir(self.directory) if not entry.name.endswith(".tmp"))
+    @staticmethod
+    def key(text: str, scope: Scope) -> str:
+        """The output of a function depends on its text, the compiler, the variables it can see
+        and the stack size of the program so far."""
+        return hashlib.sha256(json.dumps([version(), text, scope.max_offset.value, sorted(scope.items())]).encode()).hexdigest()
+    def get(self, key: str) -> tuple[list[str], int] | None:
+        """the instructions of the function and the stack size of the program after it"""
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path) as file:
+                code, max_offset = json.load(file)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return code, max_offset
+    def put(self, key: str, code: list[str], max_offset: int):
+        data = json.dumps([code, max_offset]).encode()
+        # a name of its own for every writer, threads of the server share the cache
+        temporary = None
+        try:
+            descriptor, temporary = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with open(descriptor, "wb") as file:
+                file.write(data)
+            os.replace(temporary, os.path.join(self.directory, key))
+        except OSError:
+            # the function is compiled anyway, it is just not cached
+            if temporary is not None and os.path.exists(temporary): os.unlink(temporary)
+            return
+        self.used += len(data)
+        if self.used > self.size: self.evict()
+    def evict(self):
+        """remove the least recently used entries until they take half the size"""
+        entries = sorted((entry for entry in os.scandir(self.directory) if not entry.name.endswith(".tmp")), key=lambda entry: entry.stat().st_mtime)
+        self.used = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.used <= self.size // 2: break
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                continue
+            # the stat of a DirEntry is cached, it is still there after the unlink
+            self.used -= entry.stat().st_size
+            self.evictions += 1
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "bytes": self.used}
+
+@cache
+def _item():
+    # a top level function or statement
+    from ccompiler.specialize import specialize
+    return specialize(grammar()["top_level"].parsers[0])
+
+_LBRACE, _RBRACE, _SEMICOLON = Token.LBRACE.value, Token.RBRACE.value, Token.SEMICOLON.value
+
+def _extent(tokens, start: int) -> int:
+    """end of the top level item at start, behind its `;` or closing `}`"""
+    kinds, depth = tokens.kinds, 0
+    for index in range(start, len(kinds)):
+        if (kind:=kinds[index]) == _LBRACE:
+            depth += 1
+        elif kind == _RBRACE:
+            depth -= 1
+            if depth <= 0: return index + 1
+        elif kind == _SEMICOLON and depth == 0:
+            return index + 1
+    return len(kinds)
+
+def compile_cached(source: Source, functions: FunctionCache) -> Compilation:
+    """The same as compile_source, but the assembly of the top level functions comes from the
+    cache when it has them, those functions are neither parsed nor emitted."""
+    tokens, item = source.tokens, _item()
+    # the scope Top gives its items
+    scope = Scope().create_child()
+    code = []
+    timings = {"parse": 0.0, "emit": 0.0, "cache": 0.0}
+    try:
+        while True:
+            offset = source.offset
+            mark = perf_counter()
+            key = None
+            if offset < len(tokens) and tokens.kinds[(end:=_extent(tokens, offset)) - 1] == _RBRACE:
+                key = FunctionCache.key(tokens.slice(tokens.starts[offset], tokens.ends[end - 1]), scope)
+                if (entry:=functions.get(key)) is not None:
+                    code += entry[0]
+                    scope.max_offset.value = entry[1]
+                    source.offset = end
+                    timings["cache"] += perf_counter() - mark
+                    continue
+            # how far the parse of the item looks, only items that do not look behind their end are cached
+            source.furthest = offset
+            timings["cache"] += (parsing:=perf_counter()) - mark
+            parsed = item.parse(source)
+            timings["parse"] += (emitting:=perf_counter()) - parsing
+            if parsed is None: break
+            code += (emitted:=parsed.emit(scope))
+            timings["emit"] += perf_counter() - emitting
+            if key is not None and isinstance(parsed, Function) and source.offset == end and source.furthest <= end:
+                functions.put(key, emitted, scope.max_offset.value)
+        program = Arm64Program()
+        program.code = code
+        assembly = None if (messages:=diagnostics(source)) else str(program)
+    except Exception as error:
+        assembly = None
+        # the rest of the source is still parsed, for the same diagnostics as compile_source
+        while item.parse(source) is not None: pass
+        messages = diagnostics(source) + [f"error: {error}"]
+    return Compilation(assembly, messages, timings)
@@ -0,0 +1,53 @@
+import os
+import sys
+import json
+import socket
+from ccompiler.toolchain import assemble
+
+# where the compile server listens unless told otherwise
+SOCKET = os.environ.get("CCOMPILER_SOCKET", f"/tmp/ccompiler-{os.getuid()}.sock")
+
+def request(message: dict, path: str = SOCKET) -> dict:
+    """send one request to the compile server and wait for its response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall(json.dumps(message).encode() + b"\n")
+        with connection.makefile("rb") as response:
+            return json.loads(response.readline())
+
+def main():
+    """the command line of ccompiler.compiler, compiled by the server if one is running"""
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--string", type=str)
+    parser.add_argument("--socket", type=str, default=SOCKET)
+    # required
+    parser.add_argument("-o", "--output", type=argparse.FileType("w"), required=True)
+    parser.add_argument("input", nargs="?", type=argparse.FileType("r"), default=sys.stdin)
+    args = parser.parse_args()
+    provided_string = args.string is not None
+    input_is_stdin = args.input is sys.stdin
+    assert not (provided_string and args.input and not input_is_stdin), "Cannot provide both input file and string"
+    
+    if provided_string:
+        message = {"string": args.string}
+    elif input_is_stdin:
+        message = {"string": args.input.read()}
+    else:
+        message = {"path": os.path.abspath(args.input.name)}
+    try:
+        response = request(message, args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # no server, compile in this process
+        from dataclasses import asdict
+        from ccompiler.server import compile_request
+        response = asdict(compile_request(message))
+    for diagnostic in response["diagnostics"]:
+        print(diagnostic, file=sys.stderr)
+    if response["assembly"] is None: sys.exit(1)
+    with open(f"{args.output.name}.s", "w") as f:
+        f.write(response["assembly"])
+    sys.exit(assemble(args.output.name))
+
+if __name__ == "__main__":
+    main()
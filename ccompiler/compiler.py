@@ -1,9 +1,13 @@
 import os
-from copy import deepcopy
+import sys
+from functools import cache
+from typing import Iterable
+from dataclasses import dataclass
+from time import perf_counter
 from ccompiler.tokens import Token
-from ccompiler.optim import OrOptimizer, AndOptimizer
-from ccompiler.parsers import Source, Parser, TokenParser, OrParser, BindParser
-from ccompiler.ast import BinaryOp, UnaryOp, Immidiate, Variable, Assignment, Definition, Return, EmptyStatement, Top, Function, Parameter, Block, Integer, Float, Arm64Program, Scope
+from ccompiler.toolchain import assemble
+from ccompiler.parsers import Source, MappedSource, Parser, TokenParser, OrParser, AndParser, ExpressionParser, Operator, Associativity, Action
+from ccompiler.ast import BinaryOp, UnaryOp, Immidiate, Variable, Assignment, Definition, Return, EmptyStatement, Top, Function, Parameter, Block, Integer, Float, Arm64Program, Scope, outline
 
 
 
@@ -33,111 +37,326 @@ INCREMENT = TokenParser(Token.INCREMENT)
 DECREMENT = TokenParser(Token.DECREMENT)
 RETURN = TokenParser(Token.RETURN)
 
-# TODO: Come up with a better way then bind for the creation of AST nodes. Bind destroys optimization.
-
-# Empty parsers for recursive reference - to be filled later
-expression = OrParser()
-factor = OrParser()
-term = OrParser()
-block = BindParser(None, None)
-
-# ---------- TOKEN UNIONS
-binary_operator = PLUS | MINUS | STAR | SLASH | PERCENT
-binary_operator.name = "BINOP"
-unary_operator = PLUS | MINUS
-unary_operator.name = "UNOP"
-
 _type_conversion = {Token.INT: Integer, Token.FLOAT: Float}
-_type = (INT | FLOAT).bind(lambda x: _type_conversion[x[0]])
-_type.name = "TYPE"
-identifier = IDENTIFIER.bind(lambda x: x[1])
-
-# ---------- EXPRESSIONS
-variable = identifier.bind(lambda x: Variable(x))
 _immidiate_conversion = {Token.INTEGER: Integer, Token.FLOAT: Float}
-immidiate = (INTEGER).bind(lambda x: Immidiate(_immidiate_conversion[x[0]], x[1]))
-factor.parsers = (variable | immidiate | (LPAREN & expression & RPAREN).bind(lambda x: x[1]) | (unary_operator & factor).bind(lambda x: UnaryOp(x[0][0], x[1]))).parsers
-factor.name = "FACT"
-binary_operation_l1 = (factor & (STAR | SLASH | PERCENT) & term).bind(lambda x: BinaryOp(x[0], x[1][0], x[2]))
-binary_operation_l1.name = "BINOP_L1"
-term.parsers = (binary_operation_l1 | factor).parsers
-term.name = "TERM"
-binary_operation_l2 = (term & (PLUS | MINUS) & expression).bind(lambda x: BinaryOp(x[0], x[1][0], x[2]))
-binary_operation_l2.name = "BINOP_L2"
-expression.parsers = (binary_operation_l2 | term).parsers
-expression.name = "EXP"
-
-# save for tests
-unoptimized_expression = deepcopy(expression)
-
-# ---------- SIMPLE STATEMENTS
-assignment = (identifier & EQUALS & expression).bind(lambda x: Assignment(x[0], x[2]))
-assignment.name = "ASSIGN"
+
 def extract_definition(x):
     if isinstance(x[1], Assignment):
         return Definition(x[0], x[1].identifier, x[1].expression)
     return Definition(*x)
-definition = (_type & (assignment | IDENTIFIER)).bind(extract_definition)
-definition.name = "DEF"
-return_statement = (RETURN & expression).bind(lambda x: Return(x[1]))
-return_statement.name = "RTRN_STMT"
-
-statement_body = definition | assignment | return_statement | expression
-statement_body.name = "STMT_BODY"
-statement = (statement_body & SEMICOLON).bind(lambda x: x[0]) | SEMICOLON.bind(lambda _: EmptyStatement())
-statement.name = "STATEMENT"
-
-
-_tmp = (LBRACE & (statement | block).many() & RBRACE).bind(lambda x: Block(x[1]))
-block.parsers = _tmp.parsers
-block.callback = _tmp.callback
-block.name = "BLOCK"
-parameter = (_type & identifier).bind(lambda x: Parameter(*x))
-parameter.name = "PARAM"
-def extract_parameter_list(x: list):
-    if len(x) == 0: return x
-    return [x[0], *map(lambda a: a[1],x[1])]
-parameter_list = (parameter & (COMMA & parameter).many()).default([]).bind(extract_parameter_list)
-parameter_list.name = "PARAMS"
-function = (_type & identifier & LPAREN & parameter_list & RPAREN & block).bind(lambda x: Function(x[0], x[1], x[3], x[-1]))
-function.name = "FUNC"
-
-top = (function | statement).many().bind(lambda x: Top(Block(x)))
-top.name = "TOP"
-
-OrOptimizer.optimize(top)
-AndOptimizer.optimize(top)
+
+def extract_parameter_list(first, rest: list):
+    return [first, *rest]
+
+def build_grammar() -> dict[str, Parser]:
+    """build and optimize the parser graph, returns its parsers by name"""
+    from ccompiler.optim import OrOptimizer, AndOptimizer, ActionOptimizer, LeftFactorOptimizer, FirstSetOptimizer
+    # Build AST nodes with build/select where possible, the optimizers can see through their
+    # structured actions but have to stop at every bind callback.
+    
+    # Empty parsers for recursive reference - to be filled later
+    block = AndParser()
+
+    # ---------- TOKEN UNIONS
+    binary_operator = PLUS | MINUS | STAR | SLASH | PERCENT
+    binary_operator.name = "BINOP"
+    unary_operator = PLUS | MINUS
+    unary_operator.name = "UNOP"
+
+    _type = (INT | FLOAT).build(_type_conversion.__getitem__, (0, 0))
+    _type.name = "TYPE"
+    identifier = IDENTIFIER.select(0, 1)
+
+    # ---------- EXPRESSIONS
+    # binary operators are right associative like the recursive descent grammar they replaced
+    expression = ExpressionParser(
+        binary=[
+            Operator(Token.STAR, 2, Associativity.RIGHT, BinaryOp),
+            Operator(Token.SLASH, 2, Associativity.RIGHT, BinaryOp),
+            Operator(Token.PERCENT, 2, Associativity.RIGHT, BinaryOp),
+            Operator(Token.PLUS, 1, Associativity.RIGHT, BinaryOp),
+            Operator(Token.MINUS, 1, Associativity.RIGHT, BinaryOp),
+        ],
+        prefix=[
+            Operator(Token.PLUS, 3, Associativity.RIGHT, UnaryOp),
+            Operator(Token.MINUS, 3, Associativity.RIGHT, UnaryOp),
+        ],
+    )
+    expression.name = "EXP"
+    variable = identifier.build(Variable, 0)
+    immidiate = INTEGER.build(Immidiate, Action(_immidiate_conversion.__getitem__, (0, 0)), (0, 1))
+    primary = variable | immidiate | (LPAREN & expression & RPAREN).select(1)
+    primary.name = "PRIMARY"
+    expression.parsers = [primary]
+
+    # ---------- SIMPLE STATEMENTS
+    assignment = (identifier & EQUALS & expression).build(Assignment, 0, 2)
+    assignment.name = "ASSIGN"
+    definition = (_type & (assignment | IDENTIFIER)).bind(extract_definition)
+    definition.name = "DEF"
+    return_statement = (RETURN & expression).build(Return, 1)
+    return_statement.name = "RTRN_STMT"
+
+    statement_body = definition | assignment | return_statement | expression
+    statement_body.name = "STMT_BODY"
+    statement = (statement_body & SEMICOLON).select(0) | SEMICOLON.build(EmptyStatement)
+    statement.name = "STATEMENT"
+
+
+    _tmp = (LBRACE & (statement | block).many() & RBRACE).build(Block, 1)
+    block.parsers = _tmp.parsers
+    block.action = _tmp.action
+    block.name = "BLOCK"
+    parameter = (_type & identifier).build(Parameter, 0, 1)
+    parameter.name = "PARAM"
+    parameter_list = (parameter & (COMMA & parameter).select(1).many()).build(extract_parameter_list, 0, 1).default([])
+    parameter_list.name = "PARAMS"
+    function = (_type & identifier & LPAREN & parameter_list & RPAREN & block).build(Function, 0, 1, 3, 5)
+    function.name = "FUNC"
+
+    # nothing after a complete function or statement can make the parse backtrack into it
+    top_level = (function | statement).cut().many()
+    top_level.name = "TOP_LEVEL"
+    top = top_level.build(Top, Action(Block, 0))
+    top.name = "TOP"
+
+    AndOptimizer.optimize(top)
+    ActionOptimizer.optimize(top)
+    LeftFactorOptimizer.optimize(top)
+    OrOptimizer.optimize(top)
+    FirstSetOptimizer.optimize(top)
+    parsers = {name: parser for name, parser in locals().items() if isinstance(parser, Parser)}
+    del parsers["_tmp"]
+    return parsers
+
+@cache
+def version() -> int:
+    """checksum of the python version and the sources of the compiler, it changes with either"""
+    import zlib
+    checksum = zlib.crc32(sys.version.encode())
+    package = os.path.dirname(__file__)
+    for module in sorted(os.listdir(package)):
+        if module.endswith(".py"):
+            with open(os.path.join(package, module), "rb") as file:
+                checksum = zlib.crc32(file.read(), checksum)
+    return checksum
+
+# snapshots start with it, the version and the sha256 of the pickle
+SNAPSHOT = b"CCGRAMMAR"
+
+def load_grammar(directory: str) -> dict[str, Parser]:
+    """the parsers of build_grammar, unpickled from a snapshot in directory if one was taken
+    from the current sources of the compiler, otherwise built and snapshotted"""
+    # imported here, it costs more than building the grammar when there is no snapshot to load
+    import pickle
+    import hashlib
+    import tempfile
+    path = os.path.join(directory, f"grammar-{version():08x}.pickle")
+    header = SNAPSHOT + version().to_bytes(4, "little")
+    try:
+        with open(path, "rb") as file:
+            status = os.fstat(file.fileno())
+            # unpickling runs code, only a snapshot of this user that no one else can write is loaded
+            if status.st_uid == os.getuid() and not status.st_mode & 0o022:
+                data = file.read()
+                digest, payload = data[len(header):len(header) + 32], data[len(header) + 32:]
+                if data[:len(header)] == header and hashlib.sha256(payload).digest() == digest:
+                    return pickle.loads(payload)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        pass
+    parsers = build_grammar()
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        payload = pickle.dumps(parsers, protocol=pickle.HIGHEST_PROTOCOL)
+        # write the snapshot under another name first, so no one loads it half written
+        # mkstemp makes it 0600 under a name no other writer uses
+        descriptor, temporary = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        try:
+            with open(descriptor, "wb") as file:
+                file.write(header + hashlib.sha256(payload).digest() + payload)
+            os.replace(temporary, path)
+        except OSError:
+            os.unlink(temporary)
+    except OSError:
+        pass
+    return parsers
+
+def cache_directory() -> str:
+    return os.environ.get("CCOMPILER_CACHE", os.path.expanduser("~/.cache/ccompiler"))
+
+@cache
+def grammar() -> dict[str, Parser]:
+    return load_grammar(cache_directory())
+
+@cache
+def specialized(name: str = "top") -> Parser:
+    from ccompiler.specialize import specialize
+    return specialize(grammar()[name])
+
+def cascade_expression():
+    """recursive descent expression grammar the ExpressionParser replaced, the tests compare against it"""
+    expression = OrParser()
+    factor = OrParser()
+    term = OrParser()
+    unary_operator = PLUS | MINUS
+    variable = IDENTIFIER.bind(lambda x: Variable(x[1]))
+    immidiate = (INTEGER).bind(lambda x: Immidiate(_immidiate_conversion[x[0]], x[1]))
+    factor.parsers = (variable | immidiate | (LPAREN & expression & RPAREN).bind(lambda x: x[1]) | (unary_operator & factor).bind(lambda x: UnaryOp(x[0][0], x[1]))).parsers
+    factor.name = "FACT"
+    binary_operation_l1 = (factor & (STAR | SLASH | PERCENT) & term).bind(lambda x: BinaryOp(x[0], x[1][0], x[2]))
+    binary_operation_l1.name = "BINOP_L1"
+    term.parsers = (binary_operation_l1 | factor).parsers
+    term.name = "TERM"
+    binary_operation_l2 = (term & (PLUS | MINUS) & expression).bind(lambda x: BinaryOp(x[0], x[1][0], x[2]))
+    binary_operation_l2.name = "BINOP_L2"
+    expression.parsers = (binary_operation_l2 | term).parsers
+    expression.name = "EXP"
+    return expression
+
+def __getattr__(name: str):
+    # the grammar is only built, or loaded, once one of its parsers is used
+    if name.startswith("__"): raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if name == "unoptimized_expression":
+        globals()[name] = cascade_expression()
+    else:
+        globals().update(grammar())
+    if name not in globals(): raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return globals()[name]
+
+def stream(source: Source):
+    """yield the top level functions and statements as soon as they are parsed"""
+    yield from grammar()["top_level"].stream(source)
+
+def parse_all(sources: Iterable[str | Source], parser: Parser = None, workers: int = None) -> list:
+    """parse the sources on a pool of threads that share one parser, top by default, and
+    return the results in the order of the sources"""
+    from concurrent.futures import ThreadPoolExecutor
+    parser = parser or grammar()["top"]
+    def parse(source: str | Source):
+        return parser.parse(source if isinstance(source, Source) else Source(source))
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(parse, sources))
+
+def diagnostics(source: Source) -> list[str]:
+    """why a parse of source did not get to its end"""
+    tokens = source.tokens
+    def line(offset: int) -> int:
+        return tokens.slice(0, offset).count("\n") + 1
+    messages = []
+    if source.offset < len(tokens):
+        messages.append(f"line {line(tokens.starts[source.offset])}: could not parse from {tokens.text(source.offset)!r} on")
+    elif tokens.error is not None:
+        messages.append(f"line {line(tokens.error)}: unexpected character {tokens.character(tokens.error)!r}")
+    return messages
+
+@dataclass
+class Compilation:
+    """What compiling one source gave, the assembly is None if there are diagnostics."""
+    assembly: str | None
+    diagnostics: list[str]
+    # seconds per stage
+    timings: dict[str, float]
+
+def compile_source(source: Source, parser: Parser = None) -> Compilation:
+    """parse source with parser, the specialized top by default, and generate its assembly"""
+    start = perf_counter()
+    ast = (parser or specialized()).parse(source)
+    parsed = perf_counter()
+    messages = diagnostics(source)
+    try:
+        assembly = str(Arm64Program.build(ast))
+    except Exception as error:
+        assembly = None
+        messages.append(f"error: {error}")
+    # the assembly of a source with errors would only be the part before the first one
+    if messages: assembly = None
+    return Compilation(assembly, messages, {"parse": parsed - start, "emit": perf_counter() - parsed})
 
 def main():
-    import sys
     import argparse
-    from pprint import pprint
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--string", type=str)
     parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("-p", "--profile", action="store_true")
+    parser.add_argument("-c", "--cache", action="store_true")
+    parser.add_argument("-i", "--ir", action="store_true", help="generate the code through the three address IR, dumped next to the output")
     # required
     parser.add_argument("-o", "--output", type=argparse.FileType("w"), required=True)
     parser.add_argument("input", nargs="?", type=argparse.FileType("r"), default=sys.stdin)
     args = parser.parse_args()
+    # the cache holds the assembly of the direct emitter
+    if args.ir and args.cache: parser.error("-i/--ir can not be combined with -c/--cache")
+    # cached functions are neither parsed nor profiled nor traced
+    if args.cache and (args.profile or args.verbose): parser.error("-p/--profile and -v/--verbose can not be combined with -c/--cache")
     provided_string = args.string is not None
     assert args.input or provided_string, "Either input file or string must be provided"
     input_is_stdin = args.input is sys.stdin
     assert not (provided_string and args.input and not input_is_stdin), "Cannot provide both input file and string"
     
+    # the specialized parser parses profiled and traced sources with the grammar it was made from
+    parser = specialized()
+    profile = trace = None
+    if args.profile:
+        from ccompiler.profiling import Profile
+        profile = Profile()
     if args.verbose:
-        import ccompiler.debug as debug
-        debug.init(Parser, Source)
+        from ccompiler.trace import Trace
+        trace = Trace(path=f"{args.output.name}.trace")
     
-    source = Source(args.string if provided_string else args.input.read())
-    ast = top.parse(source)
-    pprint(ast)
-    program = str(Arm64Program.build(ast))
-    with open(f"{args.output.name}.s", "w") as f:
-        f.write(program)
-    # now assemble with as
-    os.system(f"as {args.output.name}.s -o {args.output.name}.o")
-    # now link with ld
-    os.system(f"ld {args.output.name}.o -o {args.output.name} -lSystem -syslibroot /Library/Developer/CommandLineTools/SDKs/MacOSX.sdk")
+    if provided_string:
+        source = Source(args.string, profile=profile, trace=trace)
+    elif input_is_stdin:
+        source = Source(args.input.read(), profile=profile, trace=trace)
+    else:
+        # map real files instead of reading them into memory
+        source = MappedSource(args.input.name, profile=profile, trace=trace)
+    # a mapped file stays mapped until the assembly is written
+    with source:
+        if args.cache:
+            # the unchanged functions come from the cache, there is no AST of the whole source to print
+            from ccompiler.cache import FunctionCache, compile_cached
+            functions = FunctionCache()
+            compilation = compile_cached(source, functions)
+            for diagnostic in compilation.diagnostics:
+                print(diagnostic, file=sys.stderr)
+            print(f"function cache: {functions.stats()}", file=sys.stderr)
+            if (program:=compilation.assembly) is None: sys.exit(1)
+        else:
+            ast = parser.parse(source)
+            if profile is not None:
+                with open(f"{args.output.name}.profile.json", "w") as f:
+                    f.write(profile.json())
+                with open(f"{args.output.name}.folded", "w") as f:
+                    f.write(profile.collapsed())
+            if trace is not None:
+                trace.close()
+                import ccompiler.debug as debug
+                debug.show(trace.path, source)
+            print(outline(ast))
+            for diagnostic in (messages:=diagnostics(source)):
+                print(diagnostic, file=sys.stderr)
+            if messages: sys.exit(1)
+            program = None
+        # written under another name first, an error while emitting leaves no assembly behind
+        temporary = f"{args.output.name}.s.{os.getpid()}.tmp"
+        try:
+            if args.ir:
+                from ccompiler import ir
+                routines = ir.lower(ast)
+                with open(f"{args.output.name}.ir", "w") as f:
+                    f.write(ir.dump(routines))
+                program = str(ir.generate_program(routines))
+            with open(temporary, "w") as f:
+                if program is None:
+                    Arm64Program.write(ast, f)
+                else:
+                    f.write(program)
+            os.replace(temporary, f"{args.output.name}.s")
+        except Exception as error:
+            if os.path.exists(temporary): os.unlink(temporary)
+            print(f"error: {error}", file=sys.stderr)
+            sys.exit(1)
+    sys.exit(assemble(args.output.name))
     
     
 
@@ -1,4 +1,7 @@
+import argparse
 import logging
+from ccompiler.parsers import Source
+from ccompiler.trace import Status, load
 
 logger = logging.getLogger(__name__)
 
@@ -35,34 +38,36 @@ class _Debug:
                     callstack_str = f"({page})".ljust(4) + "-> " + str(call)
         logger.debug(str(cls.counter).ljust(6) + str(len(callstack)).ljust(4) + cls.color(f'{status.ljust(20)} {callstack_str.ljust(cls.CALLSTACK_WIDTH)[:cls.CALLSTACK_WIDTH]} "{source}"', cls.STAT2COL[status]))
 
-def init(Parser, Source):
+def show(path: str, source: Source, parser: str = None, start: int = None, end: int = None):
+    """log the records of the trace at path as colored call stacks, the ones of `parser`
+    starting from token start up to end only"""
     logging.basicConfig(level=logging.DEBUG)
     _debug = _Debug.debug
-    
-    si = Source.__init__
-    
-    def source_init(self, source, offset=0):
-        si(self, source, offset)
-        _Debug.counter = 0
-        _debug("SOURCE", source)
-        self.callstack = []
-    
-    Source.__init__ = source_init
-    
-    p = Parser.parse
-    
-    # we inject the following code into the parser
-    def parse(self, source: Source):
-        # if self.name is None: return self._parse(source)
-        source.callstack.append(self)
-        offset = source.offset
-        _debug("PARSING", source.source[offset:].replace("\n", " ")[:30], source.callstack)
-        parse_result = p(self, source)
-        if parse_result is not None:
-            _debug("SUCCEEDED", source.source[offset:source.offset], source.callstack)
-        else:
-            _debug("FAILED", source.source[offset:source.offset], source.callstack)
-        source.callstack.pop()
-        return parse_result
-    
-    Parser.parse = parse
+    _Debug.counter = 0
+    _debug("SOURCE", source.span(0))
+    names, records = load(path)
+    # the oldest records of a full ring buffer are gone, so are the calls they were made in
+    callstack = []
+    for name, offset, until, depth, status in records:
+        callstack[depth:] = ["?"] * (depth - len(callstack)) + [name]
+        if (parser is None or name == parser) and (start is None or offset >= start) and (end is None or offset < end):
+            if status in (Status.PARSING, Status.HIT_SUCCEEDED, Status.HIT_FAILED):
+                # every token is a character at least, 30 of them are enough for the 30 characters shown
+                _debug("PARSING", source.span(offset, min(offset + 30, len(source.tokens))).replace("\n", " ")[:30], callstack)
+            if status is not Status.PARSING:
+                _debug("FAILED" if status in (Status.FAILED, Status.HIT_FAILED) else "SUCCEEDED", source.span(offset, until), callstack)
+        if status is not Status.PARSING:
+            del callstack[depth:]
+
+def main():
+    parser = argparse.ArgumentParser(description="Show a trace of the parser")
+    parser.add_argument("trace")
+    parser.add_argument("input", type=argparse.FileType("r"))
+    parser.add_argument("-p", "--parser", type=str)
+    parser.add_argument("--start", type=int)
+    parser.add_argument("--end", type=int)
+    args = parser.parse_args()
+    show(args.trace, Source(args.input.read()), args.parser, args.start, args.end)
+
+if __name__ == "__main__":
+    main()
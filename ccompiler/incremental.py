@@ -0,0 +1,72 @@
+from bisect import bisect_left, bisect_right
+from ccompiler.lexer import Tokens, lex, relex
+from ccompiler.parsers import Source, ManyParser
+
+class Document:
+    """Parse of a source by a ManyParser of top level items that is kept up to date under edits.
+
+    Every item remembers its span of tokens and `furthest` after it completed, the parse of
+    the item did not look at any token behind that. After an edit the items that did not
+    look at the changed tokens are kept, parsing resumes behind them and stops as soon as it
+    reaches the start of an old item behind the edit, the items from there on are reused.
+    `items` and `offset` are the same as a parse of the whole source would give.
+    """
+    parser: ManyParser
+    tokens: Tokens
+    items: list
+    starts: list[int]
+    ends: list[int]
+    furthest: list[int]
+    # where the parse stopped, and how far the item parser failing there looked
+    offset: int
+    stop: int
+    # number of items that were parsed, not reused
+    parsed: int
+    def __init__(self, parser: ManyParser, source: str):
+        self.parser = parser
+        self.tokens = lex(source)
+        self.items, self.starts, self.ends, self.furthest = [], [], [], []
+        self.resume(Source(source, tokens=self.tokens))
+    @property
+    def source(self) -> str:
+        return self.tokens.source
+    def edit(self, offset: int, removed: int, inserted: str) -> "Document":
+        """the document with `removed` characters at offset replaced by `inserted`"""
+        tokens, first, old_end, new_end = relex(self.tokens, offset, removed, inserted)
+        document = Document.__new__(Document)
+        document.parser = self.parser
+        document.tokens = tokens
+        # furthest only grows from item to item
+        kept = bisect_right(self.furthest, first)
+        document.items, document.starts = self.items[:kept], self.starts[:kept]
+        document.ends, document.furthest = self.ends[:kept], self.furthest[:kept]
+        source = Source(tokens.source, self.ends[kept - 1] if kept else 0, tokens=tokens)
+        source.furthest = max(source.offset, self.furthest[kept - 1] if kept else 0)
+        document.resume(source, self, new_end, new_end - old_end)
+        return document
+    def resume(self, source: Source, previous: "Document" = None, damage: int = 0, shift: int = 0):
+        """parse items from the offset of source on, reusing the items of previous behind damage"""
+        item = self.parser.parsers[0]
+        self.parsed = 0
+        while True:
+            offset = source.offset
+            if previous is not None and offset >= damage:
+                index = bisect_left(previous.starts, offset - shift)
+                if index < len(previous.starts) and previous.starts[index] == offset - shift or previous.offset == offset - shift:
+                    self.reuse(previous, index, shift, source.furthest)
+                    return
+            if (parsed:=item.parse(source)) is None: break
+            self.items.append(parsed)
+            self.starts.append(offset)
+            self.ends.append(source.offset)
+            self.furthest.append(source.furthest)
+            self.parsed += 1
+        self.offset, self.stop = source.offset, source.furthest
+    def reuse(self, previous: "Document", index: int, shift: int, furthest: int):
+        """append the items of previous from index on, moved by shift tokens"""
+        self.items += previous.items[index:]
+        self.starts += (start + shift for start in previous.starts[index:])
+        self.ends += (end + shift for end in previous.ends[index:])
+        for end in previous.furthest[index:]:
+            self.furthest.append(furthest:=max(furthest, end + shift))
+        self.offset, self.stop = previous.offset + shift, max(furthest, previous.stop + shift)
@@ -0,0 +1,289 @@
+from enum import IntEnum
+from array import array
+from types import GeneratorType
+from ccompiler.tokens import Token
+from ccompiler import ast
+from ccompiler.ast import Arm64Program, Scope
+
+class Op(IntEnum):
+    # dst = immediate a
+    CONST = 0
+    # dst = stack slot a
+    LOAD = 1
+    # stack slot a = register b
+    STORE = 2
+    # dst = register a <op> register b
+    ADD = 3
+    SUB = 4
+    MUL = 5
+    DIV = 6
+    REM = 7
+    # dst = -register a
+    NEG = 8
+    # return register a
+    RET = 9
+
+# per operation: whether it writes dst, and whether a (1) and b (2) are registers it reads
+_DEFINES = bytes(op not in (Op.STORE, Op.RET) for op in Op)
+_USES = bytes(3 if Op.ADD <= op <= Op.REM else 2 if op == Op.STORE else 1 if op in (Op.NEG, Op.RET) else 0 for op in Op)
+_binary = {Token.PLUS: Op.ADD, Token.MINUS: Op.SUB, Token.STAR: Op.MUL, Token.SLASH: Op.DIV, Token.PERCENT: Op.REM}
+
+class Routine:
+    """Three address code of a function in parallel arrays of operation, destination and operands.
+
+    Registers are virtual and written once, variables live in stack slots of 8 bytes, the
+    slot of a variable is its address in the Scope divided by 8. `blocks` holds the index of
+    the first operation of every basic block, a RET can only end a block and the operations
+    behind it start the next one. There are no jumps yet, so only the first block is reachable
+    and has to end with a RET in a function. Routines without a name are the statements
+    between the functions, they only return if the source says so.
+    """
+    name: str | None
+    ops: array
+    dst: array
+    a: array
+    b: array
+    blocks: array
+    registers: int
+    slots: int
+    def __init__(self, name: str | None):
+        self.name = name
+        self.ops = array("B")
+        self.dst = array("i")
+        self.a = array("q")
+        self.b = array("i")
+        self.blocks = array("I", [0])
+        self.registers = 0
+        self.slots = 0
+    def emit(self, op: Op, a: int = 0, b: int = 0) -> int:
+        """append an operation, returns the register it defines, -1 if it defines none"""
+        dst = -1
+        # whatever comes behind a return is a block of its own
+        if self.ops and self.ops[-1] == Op.RET: self.blocks.append(len(self.ops))
+        if _DEFINES[op]:
+            dst = self.registers
+            self.registers = dst + 1
+        if (op == Op.LOAD or op == Op.STORE) and a >= self.slots: self.slots = a + 1
+        self.ops.append(op)
+        self.dst.append(dst)
+        self.a.append(a)
+        self.b.append(b)
+        return dst
+    @property
+    def falls_through(self) -> bool:
+        """whether the control reaches the end of the routine"""
+        return len(self.blocks) == 1 and not (self.ops and self.ops[-1] == Op.RET)
+    def __len__(self):
+        return len(self.ops)
+    def instruction(self, index: int) -> str:
+        op, dst, a, b = Op(self.ops[index]), self.dst[index], self.a[index], self.b[index]
+        if op == Op.CONST: return f"r{dst} = const {a}"
+        if op == Op.LOAD: return f"r{dst} = load s{a}"
+        if op == Op.STORE: return f"store s{a}, r{b}"
+        if op == Op.NEG: return f"r{dst} = neg r{a}"
+        if op == Op.RET: return f"ret r{a}"
+        return f"r{dst} = {op.name.lower()} r{a}, r{b}"
+    def dump(self) -> str:
+        lines = [f"function {self.name or '<top level>'} ({self.registers} registers, {self.slots} slots)"]
+        ends = [*self.blocks[1:], len(self)]
+        for number, (start, end) in enumerate(zip(self.blocks, ends)):
+            lines.append(f"  b{number}:")
+            lines.extend(f"    {self.instruction(index)}" for index in range(start, end))
+        return "\n".join(lines)
+    def validate(self):
+        """raise a ValueError if the routine is not well formed"""
+        def fail(index: int, message: str):
+            raise ValueError(f"{self.name or '<top level>'}: {index}: {message}")
+        if not len(self.ops) == len(self.dst) == len(self.a) == len(self.b): fail(0, "arrays of different length")
+        ends = [*self.blocks[1:], len(self)]
+        if self.blocks[0] != 0 or len(self) and any(start >= end for start, end in zip(self.blocks, ends)):
+            fail(0, f"blocks {list(self.blocks)} do not partition the operations")
+        ops, dsts, a, b, registers, slots = self.ops, self.dst, self.a, self.b, self.registers, self.slots
+        # the block every register is defined in
+        defined = [-1] * registers
+        for number, (start, end) in enumerate(zip(self.blocks, ends)):
+            for index in range(start, end):
+                if (op:=ops[index]) > Op.RET: fail(index, f"unknown operation {op}")
+                uses = _USES[op]
+                for register in (a[index],) * (uses & 1) + (b[index],) * (uses >> 1):
+                    if not 0 <= register < registers or defined[register] != number:
+                        fail(index, f"r{register} is used but not defined before in b{number}")
+                if (op == Op.LOAD or op == Op.STORE) and not 0 <= a[index] < slots: fail(index, f"s{a[index]} out of range")
+                if op == Op.RET and index != end - 1: fail(index, "ret in the middle of a block")
+                dst = dsts[index]
+                if not _DEFINES[op]:
+                    if dst != -1: fail(index, f"{Op(op).name} defines r{dst}")
+                elif not 0 <= dst < registers: fail(index, f"r{dst} out of range")
+                elif defined[dst] != -1: fail(index, f"r{dst} is defined twice")
+                else: defined[dst] = number
+            if end < len(self) and ops[end - 1] != Op.RET: fail(end - 1, f"b{number} ends without ret")
+        if self.name is not None and self.falls_through: fail(len(self) - 1, "the end of the function is reachable")
+
+class _Lowering:
+    """Turns the nodes into routines on an explicit stack, like `AstNode.emit`.
+
+    Every handler returns the register of the value of the node, or a generator that yields
+    the (child, scope) pairs whose registers it needs and returns it.
+    """
+    def __init__(self):
+        self.routines: list[Routine] = []
+        self.routine: Routine = None
+        self.handlers = {
+            ast.Top: self.top, ast.Block: self.block, ast.Function: self.function, ast.Definition: self.definition,
+            ast.Assignment: self.assignment, ast.Return: self.return_, ast.EmptyStatement: self.empty,
+            ast.Variable: self.variable, ast.Immidiate: self.immidiate, ast.BinaryOp: self.binary, ast.UnaryOp: self.unary,
+        }
+        self.structure = (self.top, self.block, self.function, self.empty)
+    def lower(self, node: ast.AstNode, scope: Scope) -> list[Routine]:
+        stack = []
+        value = self.handle(node, scope)
+        while True:
+            if isinstance(value, GeneratorType):
+                stack.append(value)
+                value = None
+            if not stack: return self.routines
+            try:
+                child, scope = stack[-1].send(value)
+                value = self.handle(child, scope)
+            except StopIteration as stop:
+                stack.pop()
+                value = stop.value
+    def handle(self, node: ast.AstNode, scope: Scope):
+        if (handler:=self.handlers.get(type(node))) is None:
+            raise NotImplementedError(f"lowering not implemented for {node.__class__.__name__}")
+        if self.routine is None and handler not in self.structure:
+            # statements between the functions
+            self.routines.append(routine:=Routine(None))
+            self.routine = routine
+        return handler(node, scope)
+    @staticmethod
+    def slot(address: int) -> int:
+        return address // 8
+    def top(self, node: ast.Top, scope: Scope):
+        yield node.body, scope
+    def block(self, node: ast.Block, scope: Scope):
+        scope = scope.create_child()
+        for child in node:
+            yield child, scope
+    def function(self, node: ast.Function, scope: Scope):
+        self.routines.append(routine:=Routine(node.identifier))
+        self.routine = routine
+        yield node.body, scope
+        if routine.falls_through:
+            # falling off the end of a function returns 0, like main does in C
+            routine.emit(Op.RET, routine.emit(Op.CONST, 0))
+        self.routine = None
+    def definition(self, node: ast.Definition, scope: Scope):
+        address = scope.create_var(node.identifier)
+        if node.expression is None: return
+        register = yield node.expression, scope
+        self.routine.emit(Op.STORE, self.slot(address), register)
+    def assignment(self, node: ast.Assignment, scope: Scope):
+        register = yield node.expression, scope
+        self.routine.emit(Op.STORE, self.slot(scope[node.identifier]), register)
+    def return_(self, node: ast.Return, scope: Scope):
+        register = yield node.expression, scope
+        self.routine.emit(Op.RET, register)
+    def empty(self, node: ast.EmptyStatement, scope: Scope):
+        return None
+    def variable(self, node: ast.Variable, scope: Scope) -> int:
+        return self.routine.emit(Op.LOAD, self.slot(scope[node.identifier]))
+    def immidiate(self, node: ast.Immidiate, scope: Scope) -> int:
+        return self.routine.emit(Op.CONST, int(node.value))
+    def binary(self, node: ast.BinaryOp, scope: Scope):
+        left = yield node.left, scope
+        right = yield node.right, scope
+        return self.routine.emit(_binary[node.operator], left, right)
+    def unary(self, node: ast.UnaryOp, scope: Scope):
+        register = yield node.expression, scope
+        return self.routine.emit(Op.NEG, register) if node.operator == Token.MINUS else register
+
+def lower(node: ast.AstNode, scope: Scope = None) -> list[Routine]:
+    """the routines of an AST, variables get the addresses `emit` would give them"""
+    return _Lowering().lower(node, Scope() if scope is None else scope)
+
+def dump(routines: list[Routine]) -> str:
+    return "\n".join(routine.dump() for routine in routines)
+
+# registers the backend allocates, w15 is the temporary of REM, w16 and w17 carry spilled registers
+REGISTERS = ("w8", "w9", "w10", "w11", "w12", "w13", "w14")
+_instructions = {Op.ADD: "add", Op.SUB: "sub", Op.MUL: "mul", Op.DIV: "sdiv"}
+
+def generate(routine: Routine, registers: tuple[str, ...] = REGISTERS) -> list[str]:
+    """ARM64 instructions of a routine, registers that don't fit are spilled to slots behind the variables"""
+    ops, dsts, a, b = routine.ops, routine.dst, routine.a, routine.b
+    # only the first block is reachable, there are no jumps
+    end = routine.blocks[1] if len(routine.blocks) > 1 else len(routine)
+    # the last use of every register, -1 if it is never used
+    last = [-1] * routine.registers
+    for index in range(end):
+        if (uses:=_USES[ops[index]]) & 1: last[a[index]] = index
+        if uses & 2: last[b[index]] = index
+    free = list(registers)
+    spills, spilled = [], 0
+    # a register name or the stack offset of every virtual register
+    location: list[str | int] = [None] * routine.registers
+    code = []
+    # lines that need the size of the frame
+    frames = []
+    def operand(register: int, scratch: str) -> str:
+        if type(where:=location[register]) is str: return where
+        code.append(f"ldr {scratch}, [sp, #{where}]")
+        return scratch
+    def release(register: int, index: int):
+        if last[register] == index: (free if type(location[register]) is str else spills).append(location[register])
+    for index in range(end):
+        op, dst = ops[index], dsts[index]
+        if op == Op.STORE:
+            code.append(f"str {operand(b[index], 'w16')}, [sp, #{a[index] * 8}]")
+            release(b[index], index)
+            continue
+        if op == Op.RET:
+            code.append(f"mov w0, {operand(a[index], 'w16')}")
+            frames.append(len(code))
+            code.append(None)
+            code.append("ret")
+            continue
+        left = right = None
+        if op != Op.CONST and op != Op.LOAD:
+            left = operand(a[index], "w16")
+            if op != Op.NEG: right = operand(b[index], "w17")
+            release(a[index], index)
+            if op != Op.NEG: release(b[index], index)
+        # the value of an expression statement is never used
+        if last[dst] == -1: continue
+        if free:
+            target = location[dst] = free.pop(0)
+        else:
+            if not spills:
+                spills.append((routine.slots + spilled) * 8)
+                spilled += 1
+            location[dst] = spills.pop()
+            target = "w16"
+        if op == Op.CONST: code.append(f"mov {target}, #{a[index]}")
+        elif op == Op.LOAD: code.append(f"ldr {target}, [sp, #{a[index] * 8}]")
+        elif op == Op.NEG: code.append(f"neg {target}, {left}")
+        elif op == Op.REM:
+            code.append(f"sdiv w15, {left}, {right}")
+            code.append(f"msub {target}, w15, {right}, {left}")
+        else: code.append(f"{_instructions[op]} {target}, {left}, {right}")
+        if target == "w16": code.append(f"str w16, [sp, #{location[dst]}]")
+    frame = (routine.slots + spilled) * 8
+    frame += -frame % 16
+    if routine.name is None:
+        # the statements between the functions have no frame of their own to free
+        return [line for line in code if line is not None]
+    for line in frames:
+        code[line] = f"add sp, sp, #{frame}"
+    return [f"_{routine.name}:", f"sub sp, sp, #{frame}", *code]
+
+def generate_program(routines: list[Routine], registers: tuple[str, ...] = REGISTERS) -> Arm64Program:
+    program = Arm64Program()
+    for routine in routines:
+        routine.validate()
+        program.code += generate(routine, registers)
+    return program
+
+def build(node: ast.AstNode, registers: tuple[str, ...] = REGISTERS) -> Arm64Program:
+    """the program of an AST through the IR, the counterpart of `Arm64Program.build`"""
+    return generate_program(lower(node), registers)
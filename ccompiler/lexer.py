@@ -0,0 +1,144 @@
+import re
+from sys import intern
+from array import array
+from bisect import bisect_left
+from ccompiler.tokens import Token, regex
+
+# keywords are lexed as identifiers and resolved through this table instead of
+# trying one \bkeyword\b pattern per keyword
+keywords = {
+    match.group(1): token
+    for token, pattern in regex.items()
+    if (match:=re.fullmatch(r"\\b(\w+)\\b", pattern))
+}
+
+# alternation picks the first alternative that matches, so `++` has to come before `+`
+_lexemes = [Token.INCREMENT, Token.DECREMENT, *(
+    token for token in regex
+    if token not in keywords.values() and token not in (Token.WHITESPACE, Token.INCREMENT, Token.DECREMENT)
+)]
+# ASCII, \s and \w of a str pattern match more than those of its bytes twin otherwise
+pattern = re.compile(r"\s*(?:" + "|".join(f"(?P<{token.name}>{token.regex})" for token in _lexemes) + ")", re.ASCII)
+_whitespace = re.compile(r"\s*", re.ASCII)
+# the same for sources that are bytes, e.g. memory mapped files
+_binary_pattern = re.compile(pattern.pattern.encode(), re.ASCII)
+_binary_whitespace = re.compile(_whitespace.pattern.encode(), re.ASCII)
+_binary_keywords = {word.encode(): token for word, token in keywords.items()}
+# token value by group index of the combined pattern
+_values = [None, *(token.value for token in _lexemes)]
+
+kinds = [None] * (max(token.value for token in Token) + 1)
+for token in Token:
+    kinds[token.value] = token
+
+# text of the tokens that always match the same characters, it does not have to be sliced out
+constants = [None] * len(kinds)
+for word, token in keywords.items():
+    constants[token.value] = word
+for token in _lexemes:
+    if re.fullmatch(r"(\\\W)+", token.regex):
+        constants[token.value] = token.regex[1::2]
+
+class Tokens:
+    """Token stream as parallel arrays of token kind, start and end offset.
+
+    `error` is the offset of the first character no token matches, lexing stops there.
+    A `binary` source is bytes-like, its text is decoded when it is asked for. The text of
+    identifiers and literals is interned, every occurrence of a name is the same string.
+    """
+    source: str | bytes
+    kinds: array
+    starts: array
+    ends: array
+    error: int | None
+    binary: bool
+    def __init__(self, source: str | bytes):
+        self.source = source
+        self.kinds = array("B")
+        self.starts = array("I")
+        self.ends = array("I")
+        self.error = None
+        self.binary = not isinstance(source, str)
+    def token(self, index: int) -> Token:
+        return kinds[self.kinds[index]]
+    def text(self, index: int) -> str:
+        if (text:=constants[self.kinds[index]]) is not None: return text
+        return intern(self.slice(self.starts[index], self.ends[index]))
+    def slice(self, start: int, end: int = None) -> str:
+        """source text from start up to end"""
+        text = self.source[start:end]
+        return text.decode(errors="replace") if self.binary else text
+    def character(self, offset: int) -> str:
+        """the character at offset, all of its bytes in a binary source"""
+        if not self.binary: return self.source[offset:offset + 1]
+        # a UTF-8 sequence is at most 4 bytes long, bytes that are not one decode to U+FFFD
+        return bytes(self.source[offset:offset + 4]).decode(errors="replace")[:1]
+    def __len__(self):
+        return len(self.kinds)
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.token(index), self.text(index)
+    def __repr__(self):
+        return f"Tokens({list(self)})"
+
+def lex(source: str | bytes) -> Tokens:
+    tokens = Tokens(source)
+    append_kind, append_start, append_end = tokens.kinds.append, tokens.starts.append, tokens.ends.append
+    match, whitespace, table = (_binary_pattern, _binary_whitespace, _binary_keywords) if tokens.binary else (pattern, _whitespace, keywords)
+    match = match.match
+    identifier = Token.IDENTIFIER.value
+    offset = 0
+    while (m:=match(source, offset)) is not None:
+        kind = _values[m.lastindex]
+        start, offset = m.span(m.lastindex)
+        if kind == identifier and (keyword:=table.get(source[start:offset])) is not None:
+            kind = keyword.value
+        append_kind(kind)
+        append_start(start)
+        append_end(offset)
+    if (end:=whitespace.match(source, offset).end()) < len(source):
+        tokens.error = end
+    return tokens
+
+def relex(tokens: Tokens, offset: int, removed: int, inserted: str) -> tuple[Tokens, int, int, int]:
+    """Tokens of the source with `removed` characters at offset replaced by `inserted`.
+
+    Only the tokens around the edit are lexed again, the ones before and after it are copied
+    over. Returns the new tokens, the index of the first token that changed and the index
+    behind the changed ones in the old and in the new tokens.
+    """
+    source = tokens.source[:offset] + inserted + tokens.source[offset + removed:]
+    delta = len(inserted) - removed
+    # the token that ended last before the edit may have looked at it, lexing resumes at its start
+    first = max(bisect_left(tokens.ends, offset) - 1, 0)
+    position = tokens.ends[first - 1] if first > 0 else 0
+    kinds, starts, ends = array("B"), array("I"), array("I")
+    match = pattern.match
+    identifier = Token.IDENTIFIER.value
+    # old token whose end the lexer may meet behind the edit, lexing from there on gives the old tokens
+    old = bisect_left(tokens.ends, offset + removed)
+    error = tokens.error
+    while True:
+        while old < len(tokens) and tokens.ends[old] + delta < position:
+            old += 1
+        if old < len(tokens) and tokens.ends[old] + delta == position and position >= offset + len(inserted):
+            old += 1
+            if error is not None: error += delta
+            break
+        if (m:=match(source, position)) is None:
+            error = end if (end:=_whitespace.match(source, position).end()) < len(source) else None
+            old = len(tokens)
+            break
+        kind = _values[m.lastindex]
+        start, position = m.span(m.lastindex)
+        if kind == identifier and (keyword:=keywords.get(source[start:position])) is not None:
+            kind = keyword.value
+        kinds.append(kind)
+        starts.append(start)
+        ends.append(position)
+    relexed = Tokens(source)
+    relexed.kinds = tokens.kinds[:first] + kinds + tokens.kinds[old:]
+    relexed.starts = tokens.starts[:first] + starts + array("I", (start + delta for start in tokens.starts[old:]))
+    relexed.ends = tokens.ends[:first] + ends + array("I", (end + delta for end in tokens.ends[old:]))
+    relexed.error = error
+    return relexed, first, old, first + len(kinds)
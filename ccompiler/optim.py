@@ -1,6 +1,7 @@
 from abc import abstractmethod, abstractclassmethod
+from functools import partial
 from ccompiler.util import Visitable
-from ccompiler.parsers import Visitor, Parser, OrParser, AndParser
+from ccompiler.parsers import Visitor, Parser, OrParser, AndParser, TokenParser, ManyParser, BindParser, ConstantParser, ExpressionParser, CutParser, Action, sequence
 
 
 class Optimizer(Visitor):
@@ -28,11 +29,146 @@ class OrOptimizer(ParseTreeOptimizer):
 class AndOptimizer(ParseTreeOptimizer):
     @staticmethod
     def visit(node: Parser):
-        if not isinstance(node, AndParser): return
+        if not isinstance(node, AndParser) or node.action is not None: return
         parsers = []
         for parser in node.parsers:
-            if isinstance(parser, AndParser):
+            if isinstance(parser, AndParser) and parser.action is None:
                 parsers.extend(parser.parsers)
             else:
                 parsers.append(parser)
-        node.parsers = parsers
\ No newline at end of file
+        node.parsers = parsers
+
+class ActionOptimizer(ParseTreeOptimizer):
+    """Splices sequences into the sequences that contain them and composes their actions.
+
+    A sequence without an action gets one that rebuilds its list, so the nodes that build
+    the AST can be merged as well. Runs after the AndOptimizer flattened the plain sequences.
+    """
+    @staticmethod
+    def visit(node: Parser):
+        if not isinstance(node, AndParser): return
+        if node.action is None and not any(isinstance(p, AndParser) and p.action is not None for p in node.parsers): return
+        parsers = list(node.parsers)
+        action = node.action or Action(sequence, *range(len(parsers)))
+        index = 0
+        while index < len(parsers):
+            child = parsers[index]
+            if isinstance(child, AndParser) and child is not node and \
+                    (spliced:=action.splice(index, len(child.parsers), child.action or Action(sequence, *range(len(child.parsers))))) is not None:
+                parsers[index:index + 1] = child.parsers
+                action = spliced
+                index += len(child.parsers)
+            else:
+                index += 1
+        node.parsers = parsers
+        node.action = action
+
+def _first(parsed): return parsed[0]
+def _sequence(parsed): return parsed
+def _unwrap(callback, parsed): return callback(parsed[0])
+def _tag(index, parsed): return index, parsed
+def _factored(actions, parsed):
+    index, rest = parsed[-1]
+    return actions[index]([*parsed[:-1], *rest])
+
+class LeftFactorOptimizer(ParseTreeOptimizer):
+    """Merges adjacent OrParser alternatives that start with the same parsers.
+
+    `(a & b).bind(f) | a` becomes `(a & ((b).bind(tag0) | ().bind(tag1))).bind(dispatch)`, so `a`
+    is parsed once and the tag picks the callback the original alternative would have called.
+    Expects flattened AndParsers, so it has to run after the AndOptimizer and ActionOptimizer
+    and before the OrOptimizer merges the alternatives of nested OrParsers.
+    """
+    @staticmethod
+    def split(parser: Parser) -> tuple[list[Parser], callable]:
+        """sequence of parsers and callback that builds the result of the alternative from their results"""
+        if isinstance(parser, BindParser):
+            if isinstance(parser.parsers[0], AndParser) and parser.parsers[0].action is None:
+                return list(parser.parsers[0].parsers), parser.callback
+            return [parser.parsers[0]], partial(_unwrap, parser.callback)
+        if isinstance(parser, AndParser):
+            return list(parser.parsers), parser.action or _sequence
+        return [parser], _first
+    @classmethod
+    def visit(cls, node: Parser):
+        if not isinstance(node, OrParser): return
+        groups = []
+        for parser in node.parsers:
+            sequence, action = cls.split(parser)
+            if groups and sequence and groups[-1][0][0][0] is sequence[0]:
+                groups[-1].append((sequence, action, parser))
+            else:
+                groups.append([(sequence, action, parser)])
+        node.parsers = [group[0][2] if len(group) == 1 else cls.factor(group) for group in groups]
+    @staticmethod
+    def factor(group: list) -> Parser:
+        sequences = [sequence for sequence, _, _ in group]
+        length = 1
+        while all(len(sequence) > length for sequence in sequences) and \
+                all(sequence[length] is sequences[0][length] for sequence in sequences):
+            length += 1
+        tails = OrParser(*(
+            AndParser(*sequence[length:]).bind(partial(_tag, index))
+            for index, sequence in enumerate(sequences)
+        ))
+        actions = tuple(action for _, action, _ in group)
+        return AndParser(*sequences[0][:length], tails).bind(partial(_factored, actions))
+
+class FirstSetOptimizer(ParseTreeOptimizer):
+    """Gives every OrParser a table from the next token kind to the alternatives that can start with it.
+
+    Alternatives are kept in their original order so the ordered choice is unchanged, only
+    alternatives that are bound to fail are skipped. Has to run after every optimizer that
+    rewrites `parsers`.
+    """
+    def __init__(self):
+        self.parsers: dict[Parser, None] = {}
+        self.first: dict[Parser, frozenset[int]] = {}
+        self.nullable: set[Parser] = set()
+    def visit(self, node: Parser):
+        self.parsers[node] = None
+    @classmethod
+    def optimize(cls, visitable: Visitable):
+        optimizer = cls()
+        visitable.traverse(optimizer, backwards=True)
+        # the grammar is recursive, iterate until the sets don't grow anymore
+        while any([optimizer.update(parser) for parser in optimizer.parsers]): pass
+        for parser in optimizer.parsers:
+            if isinstance(parser, OrParser):
+                optimizer.build_dispatch(parser)
+    def update(self, parser: Parser) -> bool:
+        first, nullable = frozenset(), False
+        if isinstance(parser, TokenParser):
+            first = frozenset((parser.kind,))
+        elif isinstance(parser, ConstantParser):
+            nullable = True
+        elif isinstance(parser, OrParser):
+            first = first.union(*(self.first.get(p, ()) for p in parser.parsers))
+            nullable = any(p in self.nullable for p in parser.parsers)
+        elif isinstance(parser, AndParser):
+            nullable = True
+            for p in parser.parsers:
+                first |= self.first.get(p, frozenset())
+                if p not in self.nullable:
+                    nullable = False
+                    break
+        elif isinstance(parser, ExpressionParser):
+            first = self.first.get(parser.parsers[0], frozenset()) | parser.prefix.keys()
+            nullable = parser.parsers[0] in self.nullable
+        elif isinstance(parser, (ManyParser, BindParser, CutParser)):
+            first = self.first.get(parser.parsers[0], frozenset())
+            nullable = isinstance(parser, ManyParser) or parser.parsers[0] in self.nullable
+        else:
+            # unknown parsers could start with anything
+            nullable = True
+        changed = first != self.first.get(parser) or nullable != (parser in self.nullable)
+        self.first[parser] = first
+        if nullable: self.nullable.add(parser)
+        return changed
+    def build_dispatch(self, node: OrParser):
+        kinds = frozenset().union(*(self.first[p] for p in node.parsers))
+        node.dispatch = {
+            kind: tuple(p for p in node.parsers if kind in self.first[p] or p in self.nullable)
+            for kind in kinds
+        }
+        node.fallback = tuple(p for p in node.parsers if p in self.nullable)
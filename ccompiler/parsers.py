@@ -1,105 +1,370 @@
-import re
+import os
+import mmap
 from ccompiler.tokens import Token
+from ccompiler.lexer import Tokens, lex
 from ccompiler.util import Visitor, Visitable
-from collections import OrderedDict
 from abc import abstractmethod, abstractproperty
+from dataclasses import dataclass
+from enum import Enum, auto
 
-class Cache(OrderedDict):
-    def __init__(self, maxsize=128):
-        super().__init__()
-        self.maxsize = maxsize
-    def __setitem__(self, key, value):
-        if len(self) >= self.maxsize:
-            self.popitem(last=False)
-        super().__setitem__(key, value)
+class Memo:
+    """Packrat memo table with one slot per source offset.
 
-def cache(func):
+    Every slot maps a parser to its `(result, consumed)` pair, so a parser is run at
+    most once per offset and parsing stays linear in the input size. A `window`
+    trades speed for memory: slots further than `window` offsets behind the
+    furthest parsed offset are dropped and would have to be re-parsed. A cut drops
+    every slot before the offset it committed to.
+    """
+    slots: list[dict | None]
+    window: int | None
+    low: int
+    hits: int
+    misses: int
+    def __init__(self, size: int, window: int = None):
+        self.slots = [None] * (size + 1)
+        self.window = window
+        self.low = 0
+        self.hits = 0
+        self.misses = 0
+    def evict(self, offset: int):
+        self.drop(offset - self.window)
+    def drop(self, end: int):
+        """free the slots before end"""
+        while self.low < end:
+            self.slots[self.low] = None
+            self.low += 1
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots if slot is not None)
+    def __repr__(self):
+        return f"Memo(entries={len(self)}, hits={self.hits}, misses={self.misses})"
+
+def memoize(func):
     def wrapper(self, source: Source):
-        h = hash((self, hash(source)))
-        if h in source.cache: 
-            source.offset = source.cache[h][1]
-            return source.cache[h][0]
-        source.cache[h] = (func(self, source), source.offset)
-        return source.cache[h][0]
+        memo = source.memo
+        offset = source.offset
+        if (slot:=memo.slots[offset]) is None:
+            slot = memo.slots[offset] = {}
+            if memo.window is not None: memo.evict(offset)
+        elif (entry:=slot.get(self)) is not None:
+            memo.hits += 1
+            source.offset = offset + entry[1]
+            if source.profile is not None and self.name is not None: source.profile.hit(self, source, offset)
+            if source.trace is not None: source.trace.hit(self, source, offset)
+            return entry[0]
+        memo.misses += 1
+        call = func
+        if (trace:=source.trace) is not None:
+            call = lambda parser, source: trace.call(parser, source, func)
+        if source.profile is not None and self.name is not None:
+            parsed = source.profile.call(self, source, call)
+        else:
+            parsed = call(self, source)
+        slot[self] = (parsed, source.offset - offset)
+        return parsed
     return wrapper
 
 class Source:
+    """Input of the parsers, `offset` is an index into the token stream.
+
+    A `deferred` source makes the semantic actions return Match records instead of AST
+    nodes, `resolve` runs them for the committed parse only. `furthest` is one past the
+    furthest token any parser looked at, so a parse only depends on the tokens before it.
+    A `profile` gets the statistics of the named parsers, a `trace` records every parse
+    call, both can be attached at once.
+
+    All the state of a parse is in its Source, the parsers are not changed by parsing, so
+    one grammar parses sources in many threads at once, as long as every thread has Sources
+    (and profiles and traces) of its own.
+    """
     source: str
+    tokens: Tokens
     offset: int
-    cache: dict[int, tuple[any, int]]
-    def __init__(self, source: str, offset=0):
+    memo: Memo
+    deferred: bool
+    furthest: int
+    profile: "Profile | None"
+    trace: "Trace | None"
+    def __init__(self, source: str, offset=0, window: int = None, deferred: bool = False, tokens: Tokens = None, profile: "Profile" = None, trace: "Trace" = None):
         self.source = source
+        self.tokens = lex(source) if tokens is None else tokens
         self.offset = offset
-        self.cache = Cache(maxsize=128)
+        self.memo = Memo(len(self.tokens), window=window)
+        self.deferred = deferred
+        self.furthest = offset
+        self.profile = profile
+        self.trace = trace
+    def commit(self):
+        """free the memo before the current offset, the parse does not come back to it"""
+        self.memo.drop(self.offset)
+    def peek(self) -> int | None:
+        """kind of the next token, None at the end of the input"""
+        kinds = self.tokens.kinds
+        if self.offset >= self.furthest: self.furthest = self.offset + 1
+        return kinds[self.offset] if self.offset < len(kinds) else None
+    def span(self, start: int, end: int = None) -> str:
+        """source text of the tokens from start up to end (or the end of the source)"""
+        tokens = self.tokens
+        begin = tokens.starts[start] if start < len(tokens) else len(self.source)
+        if end is None: return tokens.slice(begin)
+        return tokens.slice(begin, tokens.ends[end - 1]) if end > start else ""
+    def close(self):
+        """release the input, only a MappedSource holds on to anything"""
+    def __enter__(self):
+        return self
+    def __exit__(self, *exception):
+        self.close()
     def __repr__(self):
         return f"Source({repr(self.source)}, {self.offset})"
     def __hash__(self):
         return hash((self.source, self.offset))
 
+class MappedSource(Source):
+    """Source over a memory mapped file.
+
+    The tokens are lexed from the mapped bytes, so the file is neither read into memory nor
+    decoded up front. Only the text of the tokens the parsers ask for is decoded.
+    """
+    source: mmap.mmap | bytes
+    def __init__(self, path: str, **kwargs):
+        with open(path, "rb") as file:
+            # empty files can not be mapped
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b""
+        super().__init__(mapped, **kwargs)
+    def close(self):
+        if isinstance(self.source, mmap.mmap): self.source.close()
+    def __hash__(self):
+        # mmap objects are not hashable
+        return id(self)
+
+class Match:
+    """Semantic action of `parser` over the tokens from start to end that has not run yet."""
+    __slots__ = ("parser", "action", "start", "end", "children")
+    def __init__(self, parser: "Parser", action: callable, start: int, end: int, children: tuple):
+        self.parser = parser
+        self.action = action
+        self.start = start
+        self.end = end
+        self.children = children
+    def __repr__(self):
+        return f"Match({self.parser}, {self.start}, {self.end})"
+
+def resolve(parsed):
+    """run the semantic actions recorded in a deferred parse result, on an explicit stack
+    so that results nested as deep as the parse that made them do not hit the recursion limit"""
+    # containers whose children are being resolved: [container, children, next child, resolved children]
+    stack = []
+    while True:
+        kind = type(parsed)
+        children = parsed.children if kind is Match else parsed if kind is list or kind is tuple else None
+        if children:
+            stack.append([parsed, children, 1, []])
+            parsed = children[0]
+            continue
+        if children is not None: parsed = _resolved(parsed, [])
+        # hand the value to the containers, the ones that are complete become values themselves
+        while stack:
+            frame = stack[-1]
+            frame[3].append(parsed)
+            if frame[2] < len(frame[1]):
+                parsed = frame[1][frame[2]]
+                frame[2] += 1
+                break
+            stack.pop()
+            parsed = _resolved(frame[0], frame[3])
+        else:
+            return parsed
+
+def _resolved(container, children: list):
+    if type(container) is Match: return container.action(*children)
+    return children if type(container) is list else tuple(children)
+
 class Parser(Visitable):
     name: str = None
     _name: str = None
-    _visited = False
     # TODO: we don't need _parse, we can just use parse and call super().parse
     @abstractmethod
     def _parse(self, source: Source): pass
-    @cache
+    @memoize
     def parse(self, source: Source):
         return self._parse(source)
+    def iterate(self, source: Source):
+        """parse without recursion, the combinators are suspended on an explicit stack while
+        their sub-parsers run, so nesting is only limited by memory"""
+        memo = source.memo
+        # combinators waiting for a result: (parser, steps, offset, memo slot)
+        stack = []
+        parser = self
+        while True:
+            if not isinstance(parser, ParserNode):
+                parsed = parser.parse(source)
+            elif (slot:=memo.slots[offset:=source.offset]) is not None and (entry:=slot.get(parser)) is not None:
+                memo.hits += 1
+                source.offset = offset + entry[1]
+                parsed = entry[0]
+            else:
+                if slot is None:
+                    slot = memo.slots[offset] = {}
+                    if memo.window is not None: memo.evict(offset)
+                memo.misses += 1
+                stack.append((parser, parser.steps(source), offset, slot))
+                parsed = None
+            # resume the combinators until one asks for another parser
+            while stack:
+                node, steps, offset, slot = stack[-1]
+                try:
+                    parser = steps.send(parsed)
+                    break
+                except StopIteration as stop:
+                    parsed = stop.value
+                    stack.pop()
+                    slot[node] = (parsed, source.offset - offset)
+            else:
+                return parsed
     def __or__(self, other):
         return OrParser(self, other)
     def __and__(self, other):
         return AndParser(self, other)
     def many(self):
         return ManyParser(self)
+    def cut(self):
+        return CutParser(self)
     def bind(self, callback):
         return BindParser(self, callback)
+    def build(self, constructor, *fields):
+        """sequence of the parsers in this `&` chain whose result is built by an Action"""
+        parsers = [self]
+        while isinstance(parsers[0], AndParser) and parsers[0].action is None and parsers[0].parsers:
+            parsers[0:1] = parsers[0].parsers
+        sequence = AndParser(*parsers)
+        sequence.action = Action(constructor, *fields)
+        return sequence
+    def select(self, *path):
+        return self.build(None, path)
     def default(self, default):
         return self | ConstantParser(default)
     def __str__(self):
         return self.name or self._name or self.__class__.__name__
 
 class ParserLeave(Parser):
-    def traverse(self, visitor: Visitor, backwards=False):
+    def traverse(self, visitor: Visitor, backwards=False, path: set = None):
         visitor.visit(self)
 
 class TokenParser(ParserLeave):
     def __init__(self, token: Token):
         self.token = token
-        self.pattern = re.compile(rf"\s*({token.regex})")
+        self.kind = token.value
         self._name = token.name
     def _parse(self, source: Source):
-        if match:=self.pattern.match(source.source, source.offset):
-            source.offset = match.end()
-            return self.token, match.group(1)
+        tokens = source.tokens
+        if (offset:=source.offset) >= source.furthest: source.furthest = offset + 1
+        if offset < len(tokens.kinds) and tokens.kinds[offset] == self.kind:
+            source.offset = offset + 1
+            return self.token, tokens.text(offset)
 
 class ParserNode(Parser):
+    """Combinator over `parsers`.
+
+    `_parse` calls the sub-parsers recursively. `steps` is the same combinator as a generator
+    for `Parser.iterate`: it yields the sub-parsers whose results it needs, gets the results
+    sent back and returns its own result.
+    """
     parsers: list[Parser]
     @abstractproperty
     def symbol(self): pass
+    @abstractmethod
+    def steps(self, source: Source): pass
     def __init__(self, *parsers):
         self.parsers = parsers
     @property
     def _name(self): 
         return f'({f" {self.symbol} ".join(map(str, self.parsers))})'
-    def traverse(self, visitor: Visitor, backwards=False):
-        self._visited = True
+    def traverse(self, visitor: Visitor, backwards=False, path: set = None):
+        # the parsers on the way down to this one, the graph is cyclic. It is kept out of
+        # the parsers, so that a grammar can be traversed and parsed with by many threads
+        path = set() if path is None else path
+        path.add(self)
         if not backwards: visitor.visit(self)
         for parser in self.parsers:
-            if parser._visited: continue
-            parser.traverse(visitor, backwards=backwards)
+            if parser in path: continue
+            parser.traverse(visitor, backwards=backwards, path=path)
         if backwards: visitor.visit(self)
-        self._visited = False
+        path.discard(self)
 
 class OrParser(ParserNode):
     symbol = "|"
+    # set by the FirstSetOptimizer: next token kind -> alternatives that can match it
+    dispatch: dict[int, tuple[Parser]] = None
+    # alternatives that can match without consuming a token
+    fallback: tuple[Parser] = ()
     def _parse(self, source: Source):
-        for parser in self.parsers:
+        parsers = self.parsers if self.dispatch is None else self.dispatch.get(source.peek(), self.fallback)
+        for parser in parsers:
             if (parsed:=parser.parse(source)) is not None:
                 return parsed
+    def steps(self, source: Source):
+        parsers = self.parsers if self.dispatch is None else self.dispatch.get(source.peek(), self.fallback)
+        for parser in parsers:
+            if (parsed:=(yield parser)) is not None:
+                return parsed
+
+def sequence(*parseds):
+    return [*parseds]
+
+class Action:
+    """AST construction of a sequence that the optimizers can see through.
+
+    Calls `constructor` with one argument per field. A field is the index of a result in the
+    sequence, a path of indices into that result or a nested Action. Without a constructor
+    the only field is the result.
+    """
+    constructor: callable
+    fields: tuple
+    def __init__(self, constructor: callable, *fields):
+        self.constructor = constructor
+        self.fields = tuple(field if isinstance(field, (Action, tuple)) else (field,) for field in fields)
+    def __call__(self, parseds: list):
+        args = []
+        for field in self.fields:
+            if isinstance(field, Action):
+                args.append(field(parseds))
+                continue
+            parsed = parseds[field[0]]
+            for index in field[1:]:
+                parsed = parsed[index]
+            args.append(parsed)
+        return args[0] if self.constructor is None else self.constructor(*args)
+    def shift(self, offset: int) -> "Action":
+        return Action(self.constructor, *(
+            field.shift(offset) if isinstance(field, Action) else (field[0] + offset, *field[1:])
+            for field in self.fields
+        ))
+    def splice(self, index: int, width: int, child: "Action") -> "Action | None":
+        """this action once the `width` results `child` builds its value from replace the one at `index`,
+        None if a field would have to look into a value built by a constructor"""
+        shifted = child.shift(index)
+        fields = []
+        for field in self.fields:
+            if isinstance(field, Action):
+                if (field:=field.splice(index, width, child)) is None: return None
+            elif field[0] > index:
+                field = (field[0] + width - 1, *field[1:])
+            elif field[0] == index:
+                if shifted.constructor is None and not isinstance(shifted.fields[0], Action):
+                    field = (*shifted.fields[0], *field[1:])
+                elif len(field) > 1:
+                    return None
+                else:
+                    field = shifted if shifted.constructor is not None else shifted.fields[0]
+            fields.append(field)
+        return Action(self.constructor, *fields)
+    def __repr__(self):
+        return f"Action({getattr(self.constructor, '__name__', self.constructor)}, {', '.join(map(repr, self.fields))})"
 
 class AndParser(ParserNode):
     symbol = "&"
+    # structured action that builds the result from the list of results
+    action: Action = None
     def _parse(self, source: Source):
         parseds = []
         offset = source.offset
@@ -108,7 +373,20 @@ class AndParser(ParserNode):
                 source.offset = offset
                 return None
             parseds.append(parsed)
-        return parseds
+        return self.act(source, offset, parseds)
+    def steps(self, source: Source):
+        parseds = []
+        offset = source.offset
+        for parser in self.parsers:
+            if (parsed:=(yield parser)) is None:
+                source.offset = offset
+                return None
+            parseds.append(parsed)
+        return self.act(source, offset, parseds)
+    def act(self, source: Source, offset: int, parseds: list):
+        if self.action is None: return parseds
+        if source.deferred: return Match(self, self.action, offset, source.offset, (parseds,))
+        return self.action(parseds)
 
 class ManyParser(ParserNode):
     symbol = "*"
@@ -119,6 +397,33 @@ class ManyParser(ParserNode):
         while (parsed:=self.parsers[0].parse(source)) is not None:
             parseds.append(parsed)
         return parseds
+    def steps(self, source: Source):
+        parseds = []
+        while (parsed:=(yield self.parsers[0])) is not None:
+            parseds.append(parsed)
+        return parseds
+    def stream(self, source: Source):
+        """yield the results one at a time instead of collecting them"""
+        while (parsed:=self.parsers[0].parse(source)) is not None:
+            yield parsed
+
+class CutParser(ParserNode):
+    """Commits the parse once its parser matched.
+
+    Memo entries before the end of the match are freed, so the parse must not backtrack
+    across it anymore. If it still does, the spans before the cut are parsed again.
+    """
+    symbol = "!"
+    @property
+    def _name(self): return f"({self.parsers[0]}){self.symbol}"
+    def _parse(self, source: Source):
+        if (parsed:=self.parsers[0].parse(source)) is not None:
+            source.commit()
+        return parsed
+    def steps(self, source: Source):
+        if (parsed:=(yield self.parsers[0])) is not None:
+            source.commit()
+        return parsed
 
 class BindParser(ParserNode):
     symbol = ">>"
@@ -126,7 +431,15 @@ class BindParser(ParserNode):
         self.parsers = [parser]
         self.callback = callback
     def _parse(self, source: Source):
+        offset = source.offset
         if (parsed:=self.parsers[0].parse(source)) is None: return None
+        return self.act(source, offset, parsed)
+    def steps(self, source: Source):
+        offset = source.offset
+        if (parsed:=(yield self.parsers[0])) is None: return None
+        return self.act(source, offset, parsed)
+    def act(self, source: Source, offset: int, parsed):
+        if source.deferred: return Match(self, self.callback, offset, source.offset, (parsed,))
         return self.callback(parsed)
 
 class ConstantParser(ParserLeave):
@@ -134,4 +447,89 @@ class ConstantParser(ParserLeave):
         self.parsed = parsed
         self._name = str(parsed)
     def _parse(self, source: Source):
-        return self.parsed
\ No newline at end of file
+        return self.parsed
+
+class Associativity(Enum):
+    LEFT = auto()
+    RIGHT = auto()
+
+@dataclass(frozen=True)
+class Operator:
+    token: Token
+    precedence: int
+    associativity: Associativity
+    # called with (left, token, right) for binary and (token, operand) for prefix operators
+    constructor: callable
+
+class ExpressionParser(ParserNode):
+    """Operator precedence parser over the operands matched by its single sub-parser.
+
+    Binary and prefix operators are looked up in tables by the kind of the next token and
+    reduced on explicit stacks, so an expression is parsed in one loop no matter how many
+    precedence levels there are.
+    """
+    symbol = "~"
+    binary: dict[int, Operator]
+    prefix: dict[int, Operator]
+    def __init__(self, *parsers, binary: list[Operator] = (), prefix: list[Operator] = ()):
+        self.parsers = parsers
+        self.binary = {operator.token.value: operator for operator in binary}
+        self.prefix = {operator.token.value: operator for operator in prefix}
+    @property
+    def _name(self): return f"({self.parsers[0]}){self.symbol}"
+    def reduce(self, operators: list, operands: list, starts: list, source: Source):
+        operator, prefix, start = operators.pop()
+        starts.pop()
+        if prefix:
+            args = operator.token, operands.pop()
+        else:
+            right = operands.pop()
+            args = operands.pop(), operator.token, right
+            # the operation starts with its left operand
+            start = starts.pop()
+        starts.append(start)
+        if source.deferred:
+            operands.append(Match(self, operator.constructor, start, source.offset, args))
+        else:
+            operands.append(operator.constructor(*args))
+    def _parse(self, source: Source):
+        return self.climb(source, self.parsers[0].parse)
+    def climb(self, source: Source, parse_operand: callable):
+        """parse the operands with parse_operand, the precedence climbing is the one of steps"""
+        send = self.steps(source).send
+        try:
+            send(None)
+            while True:
+                send(parse_operand(source))
+        except StopIteration as stop:
+            return stop.value
+    def steps(self, source: Source):
+        # the operators are (operator, prefix, offset of a prefix operator), starts are the offsets of the operands
+        operands, operators, starts = [], [], []
+        # where to backtrack to if the next operand fails
+        offset, depth = source.offset, 0
+        while True:
+            while (operator:=self.prefix.get(source.peek())) is not None:
+                operators.append((operator, True, source.offset))
+                source.offset += 1
+            starts.append(source.offset)
+            if (operand:=(yield self.parsers[0])) is None:
+                # drop the operator that asked for this operand
+                source.offset = offset
+                del operators[depth:]
+                starts.pop()
+                if not operands: return None
+                break
+            operands.append(operand)
+            if (operator:=self.binary.get(source.peek())) is None: break
+            while operators and (
+                operators[-1][0].precedence > operator.precedence or
+                operators[-1][0].precedence == operator.precedence and operator.associativity is Associativity.LEFT
+            ):
+                self.reduce(operators, operands, starts, source)
+            offset, depth = source.offset, len(operators)
+            operators.append((operator, False, None))
+            source.offset += 1
+        while operators:
+            self.reduce(operators, operands, starts, source)
+        return operands[0]
@@ -0,0 +1,122 @@
+import os
+import sys
+import asyncio
+from time import perf_counter
+from dataclasses import dataclass, field
+from ccompiler.compiler import specialized
+from ccompiler.server import compile_request
+from ccompiler.batch import outputs, prepare
+from ccompiler.toolchain import Toolchain
+
+class StageError(Exception):
+    """a stage of the pipeline failed for one file"""
+
+class Stage:
+    """Runs at most `limit` jobs at once, the others wait in its queue.
+
+    Keeps the latency of every job, without the time it waited, and samples the depth of
+    the queue whenever a job arrives.
+    """
+    name: str
+    latencies: list[float]
+    depths: list[int]
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.latencies = []
+        self.depths = []
+    async def run(self, job):
+        """await the coroutine function job once a slot is free"""
+        self.depths.append(self.waiting)
+        self.waiting += 1
+        async with self.semaphore:
+            self.waiting -= 1
+            start = perf_counter()
+            try:
+                return await job()
+            finally:
+                self.latencies.append(perf_counter() - start)
+    def __repr__(self):
+        latencies, depths = self.latencies or [0.0], self.depths or [0]
+        return (f"{self.name:<9}{len(self.latencies):>5} jobs, {sum(latencies) / len(latencies) * 1000:>8.2f} ms mean "
+            f"{max(latencies) * 1000:>8.2f} ms max latency, queue depth {sum(depths) / len(depths):.1f} mean {max(depths)} max")
+
+@dataclass
+class Build:
+    """A file through the pipeline, `error` says which stage failed and why."""
+    path: str
+    output: str
+    diagnostics: list[str] = field(default_factory=list)
+    error: str = None
+
+class Pipeline:
+    """Builds executables from many files, overlapping the stages of different files.
+
+    The code generation of one file runs in a thread while the assembler and the linker of
+    others run as subprocesses, every stage with a limit of its own on the jobs it runs at once.
+    """
+    def __init__(self, toolchain: Toolchain = None, codegen: int = 1, assemble: int = 4, link: int = 4):
+        self.toolchain = toolchain or Toolchain.from_environment()
+        self.codegen = Stage("codegen", codegen)
+        self.assemble = Stage("assemble", assemble)
+        self.link = Stage("link", link)
+    @property
+    def stages(self) -> list[Stage]:
+        return [self.codegen, self.assemble, self.link]
+    async def execute(self, template: tuple[str, ...], input: str, output: str):
+        process = await asyncio.create_subprocess_exec(
+            *Toolchain.command(template, input, output), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        out, _ = await process.communicate()
+        if process.returncode != 0:
+            raise StageError(f"{template[0]} exited with {process.returncode}: {out.decode(errors='replace').strip()}")
+    async def build(self, build: Build) -> Build:
+        async def codegen():
+            compilation = await asyncio.to_thread(compile_request, {"path": build.path})
+            build.diagnostics = compilation.diagnostics
+            if compilation.assembly is None: raise StageError("code generation failed")
+            with open(f"{build.output}.s", "w") as file:
+                file.write(compilation.assembly)
+        stage = self.codegen
+        try:
+            await stage.run(codegen)
+            stage = self.assemble
+            await stage.run(lambda: self.execute(self.toolchain.assembler, f"{build.output}.s", f"{build.output}.o"))
+            stage = self.link
+            await stage.run(lambda: self.execute(self.toolchain.linker, f"{build.output}.o", build.output))
+        except Exception as error:
+            build.error = f"{stage.name}: {error}"
+        return build
+    async def run(self, paths: list[str], directory: str = None) -> list[Build]:
+        """build every file into an executable next to it, or into directory under its path relative to
+        the directory all of the files are in, in the order of the paths"""
+        executables = [os.path.splitext(output)[0] for output in prepare(paths, outputs(paths, directory))]
+        # before the first file comes in
+        await asyncio.to_thread(specialized)
+        return await asyncio.gather(*(self.build(Build(path, output)) for path, output in zip(paths, executables)))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--directory", type=str)
+    parser.add_argument("--codegen-jobs", type=int, default=1)
+    parser.add_argument("--assemble-jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--link-jobs", type=int, default=os.cpu_count())
+    parser.add_argument("inputs", nargs="+")
+    args = parser.parse_args()
+    pipeline = Pipeline(codegen=args.codegen_jobs, assemble=args.assemble_jobs, link=args.link_jobs)
+    start = perf_counter()
+    builds = asyncio.run(pipeline.run(args.inputs, args.directory))
+    elapsed = perf_counter() - start
+    for build in builds:
+        print(f"{'FAILED' if build.error else 'ok':<7}{build.path}" + (f": {build.error}" if build.error else ""))
+        for diagnostic in build.diagnostics:
+            print(f"    {diagnostic}")
+    for stage in pipeline.stages:
+        print(stage)
+    print(f"{len(builds)} files in {elapsed * 1000:.0f} ms")
+    if any(build.error for build in builds): sys.exit(1)
+
+if __name__ == "__main__":
+    main()
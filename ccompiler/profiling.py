@@ -0,0 +1,84 @@
+import json
+from time import perf_counter
+
+class Stats:
+    """What the parses of one named parser did, times in seconds and consumed in characters
+    of the source (bytes for mapped sources)."""
+    __slots__ = ("calls", "successes", "failures", "inclusive", "exclusive", "hits", "misses", "consumed")
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, 0)
+    def dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+    def __repr__(self):
+        return f"Stats({', '.join(f'{field}={value}' for field, value in self.dict().items())})"
+
+class Profile:
+    """Statistics per named parser of the parses of every source it is attached to.
+
+    Attach it with `Source(text, profile=Profile())`. Only `Parser.parse` reports to it, the
+    memo wrapper checks for a profile and costs nothing more without one. Inclusive time of
+    recursive parsers is only counted for the outermost call.
+    """
+    stats: dict[str, Stats]
+    # exclusive time per call stack of named parsers
+    stacks: dict[str, float]
+    def __init__(self):
+        self.stats = {}
+        self.stacks = {}
+        # active calls: [name, time spent in named children]
+        self.frames = []
+        self.active: dict[str, int] = {}
+    def get(self, name: str) -> Stats:
+        if (stats:=self.stats.get(name)) is None:
+            stats = self.stats[name] = Stats()
+        return stats
+    def call(self, parser, source, func: callable):
+        """run `func(parser, source)`, the memo missed for it"""
+        name = parser.name
+        offset = source.offset
+        self.frames.append(frame:=[name, 0.0])
+        self.active[name] = self.active.get(name, 0) + 1
+        start = perf_counter()
+        try:
+            parsed = func(parser, source)
+        finally:
+            elapsed = perf_counter() - start
+            self.frames.pop()
+            self.active[name] -= 1
+        stats = self.get(name)
+        stats.misses += 1
+        if self.active[name] == 0: stats.inclusive += elapsed
+        stats.exclusive += (exclusive:=elapsed - frame[1])
+        if self.frames: self.frames[-1][1] += elapsed
+        stack = ";".join(frame[0] for frame in (*self.frames, frame))
+        self.stacks[stack] = self.stacks.get(stack, 0.0) + exclusive
+        self.count(stats, parsed, source, offset)
+        return parsed
+    def hit(self, parser, source, offset: int):
+        """the memo answered for parser, source is already behind the result"""
+        stats = self.get(parser.name)
+        stats.hits += 1
+        self.count(stats, source.memo.slots[offset][parser][0], source, offset)
+    def count(self, stats: Stats, parsed, source, offset: int):
+        stats.calls += 1
+        if parsed is None:
+            stats.failures += 1
+            return
+        stats.successes += 1
+        if source.offset > offset:
+            tokens = source.tokens
+            stats.consumed += tokens.ends[source.offset - 1] - tokens.starts[offset]
+    def json(self) -> str:
+        return json.dumps({name: stats.dict() for name, stats in self.stats.items()}, indent=2)
+    def collapsed(self) -> str:
+        """exclusive time in microseconds per call stack, the input format of flamegraph.pl"""
+        return "".join(f"{stack} {round(time * 1_000_000)}\n" for stack, time in self.stacks.items())
+    def __repr__(self):
+        rows = sorted(self.stats.items(), key=lambda item: item[1].exclusive, reverse=True)
+        return "\n".join(
+            f"{name:<12}{stats.calls:>8} calls {stats.successes:>8} ok {stats.failures:>8} failed "
+            f"{stats.inclusive * 1000:>9.2f} ms incl {stats.exclusive * 1000:>9.2f} ms excl "
+            f"{stats.hits:>7} hits {stats.misses:>7} misses {stats.consumed:>9} chars"
+            for name, stats in rows
+        )
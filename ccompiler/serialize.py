@@ -0,0 +1,280 @@
+"""Binary encoding of ASTs.
+
+    stream: MAGIC, varint VERSION, flags byte, frames
+    frame:  uint32 size, varint number of new strings, (varint length, utf-8) per string, value
+    value:  varint tag, then by tag: nothing, a zigzag varint, a double, a varint index into
+            the strings, the tokens or the types, or the fields of a node in the order they
+            are declared. Lists, tuples and Blocks are a varint count and every element as a
+            uint32 size followed by the element, so a reader can skip elements.
+
+A frame is one top level item if the TOP flag is set, or the whole tree. Strings are
+interned over the whole stream, every frame brings the strings it uses first. A Reader
+finds the frames without decoding their values and decodes one of them at a time.
+"""
+import struct
+from io import BytesIO
+from dataclasses import fields
+from ccompiler.tokens import Token
+from ccompiler.ast import Top, Block, Function, Parameter, Definition, Assignment, Return, EmptyStatement, Expression, UnaryOp, BinaryOp, Variable, Immidiate, Integer, Float
+
+MAGIC = b"CCAST"
+# increase it whenever the encoding or the node classes change
+VERSION = 1
+# the frames are the items of a Top
+TOP = 1
+
+NONE, FALSE, TRUE, INT, FLOAT, STRING, TOKEN, TYPE, LIST, TUPLE = range(10)
+NODE = 16
+NODES = [Top, Block, Function, Parameter, Definition, Assignment, Return, EmptyStatement, Expression, UnaryOp, BinaryOp, Variable, Immidiate]
+TYPES = [Integer, Float]
+_node_tags = {cls: NODE + index for index, cls in enumerate(NODES)}
+_fields = [tuple(field.name for field in fields(cls)) for cls in NODES]
+_type_indices = {cls: index for index, cls in enumerate(TYPES)}
+_tokens = {token.value: token for token in Token}
+_SIZE = struct.Struct("<I")
+_DOUBLE = struct.Struct("<d")
+
+def _varint(out: bytearray, value: int):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(data, position: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80: return value, position
+        shift += 7
+
+class _Sized:
+    """an element that is preceded by its size"""
+    __slots__ = ("value",)
+    def __init__(self, value):
+        self.value = value
+
+class _Patch:
+    """writes the size of the element behind position once it is encoded"""
+    __slots__ = ("position",)
+    def __init__(self, position: int):
+        self.position = position
+
+class Writer:
+    """Writes an AST, or the items of a Top one at a time, to a binary file."""
+    def __init__(self, file, top: bool = True):
+        self.file = file
+        self.strings: dict[str, int] = {}
+        header = bytearray(MAGIC)
+        _varint(header, VERSION)
+        header.append(TOP if top else 0)
+        file.write(header)
+    def write(self, node):
+        """write a frame with node"""
+        new = []
+        out = bytearray()
+        stack = [node]
+        while stack:
+            value = stack.pop()
+            if (tag:=_node_tags.get(type(value))) is not None:
+                _varint(out, tag)
+                if tag == NODE + 1:
+                    # a Block is a list
+                    _varint(out, len(value))
+                    stack.extend(map(_Sized, reversed(value)))
+                else:
+                    stack.extend(getattr(value, name) for name in reversed(_fields[tag - NODE]))
+            elif type(value) is _Sized:
+                stack.append(_Patch(len(out)))
+                out += b"\0\0\0\0"
+                stack.append(value.value)
+            elif type(value) is _Patch:
+                _SIZE.pack_into(out, value.position, len(out) - value.position - 4)
+            elif type(value) is str:
+                if (index:=self.strings.get(value)) is None:
+                    index = self.strings[value] = len(self.strings)
+                    new.append(value)
+                out.append(STRING)
+                _varint(out, index)
+            elif value is None:
+                out.append(NONE)
+            elif isinstance(value, Token):
+                out.append(TOKEN)
+                _varint(out, value.value)
+            elif type(value) is bool:
+                out.append(TRUE if value else FALSE)
+            elif type(value) is int:
+                out.append(INT)
+                _varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+            elif type(value) is float:
+                out.append(FLOAT)
+                out += _DOUBLE.pack(value)
+            elif type(value) in (list, tuple):
+                out.append(LIST if type(value) is list else TUPLE)
+                _varint(out, len(value))
+                stack.extend(map(_Sized, reversed(value)))
+            elif (index:=_type_indices.get(value)) is not None:
+                out.append(TYPE)
+                _varint(out, index)
+            else:
+                raise TypeError(f"cannot serialize {value!r}")
+        frame = bytearray()
+        _varint(frame, len(new))
+        for string in new:
+            encoded = string.encode()
+            _varint(frame, len(encoded))
+            frame += encoded
+        self.file.write(_SIZE.pack(len(frame) + len(out)) + frame + out)
+
+def dump(ast, file):
+    """write ast to a binary file, a Top item by item so that they can be loaded lazily"""
+    if isinstance(ast, Top):
+        writer = Writer(file)
+        for node in ast.body:
+            writer.write(node)
+    else:
+        Writer(file, top=False).write(ast)
+
+def dumps(ast) -> bytes:
+    buffer = BytesIO()
+    dump(ast, buffer)
+    return buffer.getvalue()
+
+def decode(data, position: int, strings: list[str]):
+    """the value at position"""
+    # containers being decoded: [class or LIST/TUPLE, number of values left, values, sized]
+    stack = []
+    sized = False
+    while True:
+        if sized:
+            # skip the size of the element
+            position += 4
+        if (tag:=data[position]) < 0x80:
+            position += 1
+        else:
+            tag, position = _read_varint(data, position)
+        if tag >= NODE:
+            cls = NODES[tag - NODE]
+            if cls is Block:
+                count, position = _read_varint(data, position)
+                frame = [Block, count, Block(), True]
+            else:
+                frame = [cls, len(_fields[tag - NODE]), [], False]
+            if frame[1]:
+                stack.append(frame)
+                sized = frame[3]
+                continue
+            value = frame[2] if cls is Block else cls()
+        elif tag == STRING and (index:=data[position]) < 0x80:
+            value = strings[index]
+            position += 1
+        elif tag == LIST or tag == TUPLE:
+            count, position = _read_varint(data, position)
+            if count:
+                stack.append([tag, count, [], True])
+                sized = True
+                continue
+            value = [] if tag == LIST else ()
+        else:
+            value, position = _scalar(data, position, tag, strings)
+        # hand the value to the containers, the ones that are complete become values themselves
+        while stack:
+            frame = stack[-1]
+            frame[2].append(value)
+            frame[1] -= 1
+            if frame[1]: break
+            stack.pop()
+            kind = frame[0]
+            value = frame[2] if kind is Block or kind == LIST else tuple(frame[2]) if kind == TUPLE else kind(*frame[2])
+        else:
+            return value, position
+        sized = frame[3]
+
+def _scalar(data, position: int, tag: int, strings: list[str]):
+    if tag == STRING:
+        index, position = _read_varint(data, position)
+        return strings[index], position
+    if tag == NONE: return None, position
+    if tag == TOKEN:
+        value, position = _read_varint(data, position)
+        return _tokens[value], position
+    if tag == TYPE:
+        index, position = _read_varint(data, position)
+        return TYPES[index], position
+    if tag == INT:
+        value, position = _read_varint(data, position)
+        return value >> 1 if not value & 1 else -((value + 1) >> 1), position
+    if tag == FLOAT: return _DOUBLE.unpack_from(data, position)[0], position + 8
+    if tag == TRUE or tag == FALSE: return tag == TRUE, position
+    raise ValueError(f"unknown tag {tag} at {position - 1}")
+
+def _header(data) -> tuple[int, int]:
+    """flags and the position of the first frame"""
+    if bytes(data[:len(MAGIC)]) != MAGIC: raise ValueError("not an encoded AST")
+    version, position = _read_varint(data, len(MAGIC))
+    if version != VERSION: raise ValueError(f"encoded AST has version {version}, expected {VERSION}")
+    return data[position], position + 1
+
+def _strings(data, position: int, strings: list[str]) -> int:
+    """append the strings a frame brings to strings, returns the position of its value"""
+    count, position = _read_varint(data, position)
+    for _ in range(count):
+        length, position = _read_varint(data, position)
+        strings.append(bytes(data[position:position + length]).decode())
+        position += length
+    return position
+
+class Reader:
+    """Encoded AST whose frames are only decoded when they are asked for.
+
+    `reader[i]` is the i-th top level item of an encoded Top, `function(name)` finds a
+    function by its name while decoding nothing but the names.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.flags, position = _header(data)
+        self.strings = []
+        # positions of the values of the frames
+        self.values = []
+        while position < len(data):
+            size, = _SIZE.unpack_from(data, position)
+            self.values.append(_strings(data, position + 4, self.strings))
+            position += 4 + size
+    def __len__(self):
+        return len(self.values)
+    def __getitem__(self, index: int):
+        return decode(self.data, self.values[index], self.strings)[0]
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+    def name(self, index: int) -> str | None:
+        """the name of the function in a frame, None if it is not a function"""
+        data, position = self.data, self.values[index]
+        tag, position = _read_varint(data, position)
+        if tag != _node_tags[Function]: return None
+        # the return type comes before the name
+        _, position = _scalar(data, position + 1, data[position], self.strings)
+        return _scalar(data, position + 1, data[position], self.strings)[0]
+    def function(self, name: str) -> Function:
+        for index in range(len(self)):
+            if self.name(index) == name: return self[index]
+        raise KeyError(name)
+    def load(self):
+        """the whole tree"""
+        return Top(Block(self)) if self.flags & TOP else self[0]
+
+def loads(data):
+    return Reader(data).load()
+
+def iterload(file):
+    """decode the frames of a binary file one after the other as they are read"""
+    # the version is a single byte varint
+    _header(file.read(len(MAGIC) + 2))
+    strings = []
+    while len(size:=file.read(4)) == 4:
+        frame = file.read(_SIZE.unpack(size)[0])
+        yield decode(frame, _strings(frame, 0, strings), strings)[0]
+
+def load(file):
+    return loads(file.read())
@@ -0,0 +1,81 @@
+import os
+import json
+import stat
+import errno
+import socket
+import socketserver
+from dataclasses import asdict
+from ccompiler.parsers import Source, MappedSource
+from ccompiler.compiler import Compilation, compile_source, specialized
+from ccompiler.client import SOCKET
+
+def compile_request(message: dict, functions: "FunctionCache" = None) -> Compilation:
+    """compile the `string` or the file at `path` of a request, with the functions from the cache if one is given"""
+    with Source(message["string"]) if "string" in message else MappedSource(message["path"]) as source:
+        if functions is not None:
+            from ccompiler.cache import compile_cached
+            return compile_cached(source, functions)
+        return compile_source(source)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # a connection that only checks whether the server is up
+        if not (line:=self.rfile.readline()): return
+        try:
+            compilation = asdict(compile_request(json.loads(line), self.server.functions))
+        except Exception as error:
+            compilation = asdict(Compilation(None, [f"error: {error}"], {}))
+        self.wfile.write(json.dumps(compilation).encode() + b"\n")
+
+def _remove_stale(path: str):
+    """unlink the socket a server left behind when it did not shut down, but not one a server listens on"""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode): return
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise OSError(errno.EADDRINUSE, f"a server is already listening on {path}")
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Compiles requests on a unix socket with a grammar and specialized parser that stay warm.
+
+    Every request is one line of json with either the source `string` or the `path` of a
+    file, the response is one line of json with the fields of a Compilation. Each request
+    runs in a thread of its own on a Source of its own, the parsers keep no state between
+    parses so all of them share one parser. With a FunctionCache the unchanged functions
+    of the sources are not compiled again.
+    """
+    daemon_threads = True
+    def __init__(self, path: str = SOCKET, functions: "FunctionCache" = None):
+        self.functions = functions
+        # load and specialize the grammar before the first request comes in
+        specialized()
+        _remove_stale(path)
+        super().__init__(path, _Handler)
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address): os.unlink(self.server_address)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, default=SOCKET)
+    parser.add_argument("-c", "--cache", action="store_true")
+    args = parser.parse_args()
+    functions = None
+    if args.cache:
+        from ccompiler.cache import FunctionCache
+        functions = FunctionCache()
+    with Server(args.socket, functions) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import re
+import linecache
+from ccompiler.util import Visitor
+from ccompiler.parsers import Source, Parser, ParserLeave, TokenParser, ConstantParser, OrParser, AndParser, ManyParser, BindParser, ExpressionParser, CutParser, Action
+
+# python refuses more than 20 statically nested blocks, deeper parsers get their own function
+MAX_NESTING = 12
+
+class _Functions(Visitor):
+    """collects the parsers that get a function of their own"""
+    def __init__(self):
+        self.parsers: dict[Parser, None] = {}
+    def visit(self, parser: Parser):
+        if parser.name is not None:
+            self.parsers[parser] = None
+        if isinstance(parser, ExpressionParser):
+            self.parsers[parser.parsers[0]] = None
+
+class _Generator:
+    """Writes one python function per parser in `functions`, inlining every other parser into it."""
+    def __init__(self):
+        self.lines: list[str] = []
+        self.constants: dict[str, object] = {}
+        self.names: dict[int, str] = {}
+        self.functions: dict[Parser, str] = {}
+        self.pending: list[Parser] = []
+        self.inlining: set[Parser] = set()
+        self.counter = 0
+    def constant(self, value) -> str:
+        if id(value) not in self.names:
+            self.names[id(value)] = f"C{len(self.constants)}"
+            self.constants[self.names[id(value)]] = value
+        return self.names[id(value)]
+    def variable(self) -> str:
+        self.counter += 1
+        return f"v{self.counter}"
+    def function(self, parser: Parser) -> str:
+        if parser not in self.functions:
+            name = re.sub(r"\W", "_", parser.name or parser.__class__.__name__)
+            self.functions[parser] = f"p{len(self.functions)}_{name}"
+            self.pending.append(parser)
+        return self.functions[parser]
+    def write(self, indent: int, line: str):
+        self.lines.append("    " * indent + line)
+    def generate(self):
+        while self.pending:
+            self.counter = 0
+            self.write_function(self.pending.pop(0))
+        return "\n".join(self.lines) + "\n"
+    def write_function(self, parser: Parser):
+        key = self.constant(parser)
+        self.write(0, f"def {self.functions[parser]}(source):")
+        self.write(1, "memo = source.memo")
+        self.write(1, "offset = source.offset")
+        self.write(1, "if (slot:=memo.slots[offset]) is None:")
+        self.write(2, "slot = memo.slots[offset] = {}")
+        self.write(2, "if memo.window is not None: memo.evict(offset)")
+        self.write(1, f"elif (entry:=slot.get({key})) is not None:")
+        self.write(2, "memo.hits += 1")
+        self.write(2, "source.offset = offset + entry[1]")
+        self.write(2, "return entry[0]")
+        self.write(1, "memo.misses += 1")
+        self.write(1, "tokens = source.tokens")
+        self.write(1, "kinds, text = tokens.kinds, tokens.text")
+        self.write(1, "length = len(kinds)")
+        self.inline(parser, "parsed", 1, 0)
+        self.write(1, f"slot[{key}] = (parsed, source.offset - offset)")
+        self.write(1, "return parsed")
+        self.write(0, "")
+    def call(self, parser: Parser, target: str, indent: int, nesting: int):
+        """write code that parses `parser` into `target`"""
+        if isinstance(parser, (TokenParser, ConstantParser)) or (
+                parser not in self.functions and parser not in self.inlining and nesting < MAX_NESTING):
+            self.inline(parser, target, indent, nesting)
+        else:
+            self.write(indent, f"{target} = {self.function(parser)}(source)")
+    def action(self, action: Action, parseds: list[str]) -> str:
+        """expression that calls the constructors of an action"""
+        args = [
+            self.action(field, parseds) if isinstance(field, Action) else parseds[field[0]] + "".join(f"[{i}]" for i in field[1:])
+            for field in action.fields
+        ]
+        return args[0] if action.constructor is None else f"{self.constant(action.constructor)}({', '.join(args)})"
+    def inline(self, parser: Parser, target: str, indent: int, nesting: int):
+        self.inlining.add(parser)
+        self._inline(parser, target, indent, nesting)
+        self.inlining.discard(parser)
+    def _inline(self, parser: Parser, target: str, indent: int, nesting: int):
+        write = self.write
+        if isinstance(parser, TokenParser):
+            write(indent, "if (i:=source.offset) >= source.furthest: source.furthest = i + 1")
+            write(indent, f"if i < length and kinds[i] == {parser.kind}:")
+            write(indent + 1, "source.offset = i + 1")
+            write(indent + 1, f"{target} = ({self.constant(parser.token)}, text(i))")
+            write(indent, "else:")
+            write(indent + 1, f"{target} = None")
+        elif isinstance(parser, ConstantParser):
+            write(indent, f"{target} = {self.constant(parser.parsed)}")
+        elif isinstance(parser, OrParser):
+            kind = self.variable()
+            write(indent, "while True:")
+            if parser.dispatch is not None:
+                write(indent + 1, f"{kind} = source.peek()")
+            for alternative in parser.parsers:
+                inner = indent + 1
+                if parser.dispatch is not None and alternative not in parser.fallback:
+                    viable = frozenset(k for k, parsers in parser.dispatch.items() if alternative in parsers)
+                    write(inner, f"if {kind} in {self.constant(viable)}:")
+                    inner += 1
+                self.call(alternative, target, inner, nesting + 1)
+                write(inner, f"if {target} is not None: break")
+            write(indent + 1, f"{target} = None")
+            write(indent + 1, "break")
+        elif isinstance(parser, AndParser):
+            start = self.variable()
+            write(indent, "while True:")
+            write(indent + 1, f"{start} = source.offset")
+            parseds = []
+            for element in parser.parsers:
+                parseds.append(parsed:=self.variable())
+                self.call(element, parsed, indent + 1, nesting + 1)
+                write(indent + 1, f"if {parsed} is None:")
+                write(indent + 2, f"source.offset = {start}")
+                write(indent + 2, f"{target} = None")
+                write(indent + 2, "break")
+            if parser.action is None:
+                write(indent + 1, f"{target} = [{', '.join(parseds)}]")
+            else:
+                write(indent + 1, f"{target} = {self.action(parser.action, parseds)}")
+            write(indent + 1, "break")
+        elif isinstance(parser, ManyParser):
+            parsed = self.variable()
+            write(indent, f"{target} = []")
+            write(indent, "while True:")
+            self.call(parser.parsers[0], parsed, indent + 1, nesting + 1)
+            write(indent + 1, f"if {parsed} is None: break")
+            write(indent + 1, f"{target}.append({parsed})")
+        elif isinstance(parser, BindParser):
+            parsed = self.variable()
+            self.call(parser.parsers[0], parsed, indent, nesting)
+            write(indent, f"{target} = None if {parsed} is None else {self.constant(parser.callback)}({parsed})")
+        elif isinstance(parser, CutParser):
+            self.call(parser.parsers[0], target, indent, nesting)
+            write(indent, f"if {target} is not None: source.commit()")
+        elif isinstance(parser, ExpressionParser):
+            write(indent, f"{target} = {self.constant(parser)}.climb(source, {self.function(parser.parsers[0])})")
+        else:
+            write(indent, f"{target} = {self.constant(parser)}.parse(source)")
+
+class SpecializedParser(ParserLeave):
+    """Parser compiled from a combinator graph into plain python functions.
+
+    Produces the same results as the graph it was compiled from, which `reference` keeps
+    around and parses deferred, profiled and traced sources with, and with `Parser.iterate` the
+    sources that are nested too deep for the python stack. Only parsers that got a function
+    are memoized, under the same key as in the graph. `code` is the generated module.
+    """
+    reference: Parser
+    code: str
+    def __init__(self, reference: Parser):
+        self.reference = reference
+        self._name = f"specialized {reference}"
+        functions = _Functions()
+        reference.traverse(functions)
+        generator = _Generator()
+        entry = generator.function(reference)
+        for parser in functions.parsers:
+            generator.function(parser)
+        self.code = generator.generate()
+        filename = f"<specialized {reference.name or id(reference)}>"
+        # register the source so that tracebacks show the generated lines
+        linecache.cache[filename] = (len(self.code), None, self.code.splitlines(True), filename)
+        namespace = dict(generator.constants)
+        exec(compile(self.code, filename, "exec"), namespace)
+        self.function = namespace[entry]
+    def parse(self, source: Source):
+        offset = source.offset
+        try:
+            if source.deferred or source.profile is not None or source.trace is not None: return self.reference.parse(source)
+            return self.function(source)
+        except RecursionError:
+            # nested deeper than the python stack goes, the memo keeps what was parsed so far
+            source.offset = offset
+            return self.reference.iterate(source)
+    def _parse(self, source: Source):
+        return self.function(source)
+
+def specialize(parser: Parser) -> SpecializedParser:
+    return SpecializedParser(parser)
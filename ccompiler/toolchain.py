@@ -0,0 +1,33 @@
+import os
+import shlex
+import subprocess
+from dataclasses import dataclass
+
+SDK = "/Library/Developer/CommandLineTools/SDKs/MacOSX.sdk"
+
+@dataclass(frozen=True)
+class Toolchain:
+    """Commands of the assembler and the linker, `{input}` and `{output}` in their arguments
+    are replaced by the files. `$CCOMPILER_AS` and `$CCOMPILER_LD` replace the defaults, e.g.
+    with a cross toolchain like `aarch64-linux-gnu-as {input} -o {output}`."""
+    assembler: tuple[str, ...] = ("as", "{input}", "-o", "{output}")
+    linker: tuple[str, ...] = ("ld", "{input}", "-o", "{output}", "-lSystem", "-syslibroot", SDK)
+    @classmethod
+    def from_environment(cls) -> "Toolchain":
+        toolchain = cls()
+        return cls(
+            tuple(shlex.split(os.environ["CCOMPILER_AS"])) if "CCOMPILER_AS" in os.environ else toolchain.assembler,
+            tuple(shlex.split(os.environ["CCOMPILER_LD"])) if "CCOMPILER_LD" in os.environ else toolchain.linker)
+    @staticmethod
+    def command(template: tuple[str, ...], input: str, output: str) -> list[str]:
+        # not str.format, other braces in the arguments stay as they are
+        return [argument.replace("{input}", input).replace("{output}", output) for argument in template]
+
+def assemble(output: str, toolchain: Toolchain = None) -> int:
+    """assemble `output`.s and link it into the executable output, returns the exit status of
+    the tool that failed, 0 if both succeeded"""
+    toolchain = toolchain or Toolchain.from_environment()
+    # now assemble with as
+    if (status:=subprocess.run(toolchain.command(toolchain.assembler, f"{output}.s", f"{output}.o")).returncode) != 0: return status
+    # now link with ld
+    return subprocess.run(toolchain.command(toolchain.linker, f"{output}.o", output)).returncode
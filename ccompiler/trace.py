@@ -0,0 +1,100 @@
+import mmap
+import json
+import struct
+from enum import IntEnum
+
+# parser id, start and end token offset, depth, status
+RECORD = struct.Struct("<IIIHBx")
+# magic, capacity in records, records written
+HEADER = struct.Struct("<4sIQ")
+MAGIC = b"CCTR"
+
+class Status(IntEnum):
+    PARSING = 0
+    SUCCEEDED = 1
+    FAILED = 2
+    # answered by the memo
+    HIT_SUCCEEDED = 3
+    HIT_FAILED = 4
+
+class Trace:
+    """Records every parse call of a source as fixed size binary records into a ring buffer.
+
+    Attach it with `Source(text, trace=Trace())`. The buffer is preallocated, in memory or
+    as a memory mapped file, once it is full the oldest records are overwritten. Nothing is
+    formatted while parsing, `ccompiler.debug` shows a saved trace. The names of the parsers
+    are written next to the records, into `<path>.names`.
+    """
+    capacity: int
+    written: int
+    depth: int
+    names: list[str]
+    def __init__(self, capacity: int = 1 << 20, path: str = None):
+        self.capacity = capacity
+        self.written = 0
+        self.depth = 0
+        self.ids = {}
+        self.names = []
+        self.path = path
+        size = HEADER.size + capacity * RECORD.size
+        if path is None:
+            self.buffer = bytearray(size)
+        else:
+            with open(path, "w+b") as file:
+                file.truncate(size)
+                self.buffer = mmap.mmap(file.fileno(), size)
+    def id(self, parser) -> int:
+        if (id:=self.ids.get(parser)) is None:
+            id = self.ids[parser] = len(self.names)
+            self.names.append(str(parser))
+        return id
+    def record(self, parser, start: int, end: int, status: Status, depth: int):
+        position = HEADER.size + self.written % self.capacity * RECORD.size
+        RECORD.pack_into(self.buffer, position, self.id(parser), start, end, depth, status)
+        self.written += 1
+    def call(self, parser, source, func: callable):
+        """run `func(parser, source)`, the memo missed for it"""
+        start, depth = source.offset, self.depth
+        self.record(parser, start, start, Status.PARSING, depth)
+        self.depth += 1
+        try:
+            parsed = func(parser, source)
+        finally:
+            self.depth = depth
+        self.record(parser, start, source.offset, Status.FAILED if parsed is None else Status.SUCCEEDED, depth)
+        return parsed
+    def hit(self, parser, source, offset: int):
+        """the memo answered for parser, source is already behind the result"""
+        failed = source.memo.slots[offset][parser][0] is None
+        self.record(parser, offset, source.offset, Status.HIT_FAILED if failed else Status.HIT_SUCCEEDED, self.depth)
+    def save(self, path: str = None):
+        """write the trace to path, a mapped trace is flushed to its own file by default"""
+        HEADER.pack_into(self.buffer, 0, MAGIC, self.capacity, self.written)
+        if (path:=path or self.path) is None: raise ValueError("a trace in memory needs a path to be saved to")
+        if path != self.path:
+            with open(path, "wb") as file:
+                file.write(self.buffer)
+        else:
+            self.buffer.flush()
+        with open(f"{path}.names", "w") as file:
+            json.dump(self.names, file)
+    def close(self):
+        """save a mapped trace and unmap it, a trace in memory has nothing to close"""
+        if self.path is None: return
+        self.save()
+        self.buffer.close()
+
+def load(path: str) -> tuple[list[str], list[tuple[str, int, int, int, Status]]]:
+    """names of the parsers and the records of a saved trace, oldest first"""
+    with open(f"{path}.names") as file:
+        names = json.load(file)
+    with open(path, "rb") as file:
+        buffer = file.read()
+    magic, capacity, written = HEADER.unpack_from(buffer)
+    if magic != MAGIC: raise Exception(f"{path} is not a trace")
+    first = max(written - capacity, 0)
+    records = []
+    for index in range(first, written):
+        id, start, end, depth, status = RECORD.unpack_from(buffer, HEADER.size + index % capacity * RECORD.size)
+        records.append((names[id], start, end, depth, Status(status)))
+    return names, records
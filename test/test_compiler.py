@@ -1,10 +1,49 @@
+import os
+import io
+import atexit
+import shutil
+import shlex
+import json
+import pickle
+import pytest
+import asyncio
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from socket import socket as unix_socket, AF_UNIX, SOCK_STREAM
+import tracemalloc
 from copy import deepcopy
+from pathlib import Path
+from time import perf_counter
 from timeit import repeat
+# the tests build the grammar on import, its snapshot goes into a directory of their own
+os.environ["CCOMPILER_CACHE"] = tempfile.mkdtemp(prefix="ccompiler-test-")
+atexit.register(shutil.rmtree, os.environ["CCOMPILER_CACHE"], ignore_errors=True)
 from ccompiler.tokens import Token
-from ccompiler.optim import OrOptimizer, AndOptimizer
-from ccompiler.parsers import Source, TokenParser
-from ccompiler.compiler import unoptimized_expression, expression, parameter_list
-from ccompiler.ast import BinaryOp, UnaryOp, Immidiate, Parameter, Integer
+from ccompiler.optim import OrOptimizer, AndOptimizer, ActionOptimizer, LeftFactorOptimizer, FirstSetOptimizer
+from ccompiler.util import Visitor
+from ccompiler.parsers import Source, MappedSource, TokenParser, OrParser, ParserNode, ExpressionParser, Operator, Associativity, Action, Match, resolve
+from ccompiler.lexer import lex
+from ccompiler.specialize import specialize
+from ccompiler.profiling import Profile
+from ccompiler.trace import Trace, Status, load, RECORD, HEADER
+from ccompiler import debug
+from ccompiler.incremental import Document
+from ccompiler import compiler
+from ccompiler.server import Server
+from ccompiler.client import request
+from ccompiler.batch import compile_batch, manifest
+from ccompiler.toolchain import Toolchain, assemble
+from ccompiler.pipeline import Pipeline
+from ccompiler.cache import FunctionCache, compile_cached
+from ccompiler import serialize
+from ccompiler import ir
+from ccompiler.compiler import unoptimized_expression, expression, parameter_list, top, top_level, primary, stream
+from ccompiler.ast import AstNode, Function, Arm64Program, CodeWriter, Scope, MaxOffset, BinaryOp, UnaryOp, Immidiate, Parameter, Integer, Variable
+
+HELLO = (Path(__file__).parent.parent / "hello.c").read_text()
 
 INT = TokenParser(Token.INT)
 IDENTIFIER = TokenParser(Token.IDENTIFIER)
@@ -16,6 +55,15 @@ def test_token_parser():
     assert INT.parse(Source("int")) == (Token.INT, "int")
     assert INT.parse(Source("  \n int")) == (Token.INT, "int")
 
+def test_lexer():
+    assert list(lex("int integer = a++ + 12;")) == [
+        (Token.INT, "int"), (Token.IDENTIFIER, "integer"), (Token.EQUALS, "="), (Token.IDENTIFIER, "a"),
+        (Token.INCREMENT, "++"), (Token.PLUS, "+"), (Token.INTEGER, "12"), (Token.SEMICOLON, ";")]
+    assert list(lex("_Bool\n\treturn_")) == [(Token._BOOL, "_Bool"), (Token.IDENTIFIER, "return_")]
+    tokens = lex("a = 1.5;")
+    assert len(tokens) == 2 and tokens.error == 4
+    assert lex("  ").error is None
+
 def test_or():
     assert (INT | INT).parse(Source("   \n int")) == (Token.INT, "int")
     assert (INT | IDENTIFIER).parse(Source(" asd12")) == (Token.IDENTIFIER, "asd12")
@@ -48,6 +96,703 @@ def test_optimizer_and_or_equals_or_and():
     assert and_or.parse(Source("-5/5-")) == or_and.parse(Source("-5/5-"))
 
 
+def test_memo():
+    source = Source("int int")
+    assert ((INT & IDENTIFIER) | (INT & INT)).parse(source) == [(Token.INT, "int"), (Token.INT, "int")]
+    assert source.memo.hits == 1
+    source = Source("1 + 2 * (3 - 4)")
+    out = expression.parse(source)
+    # every parser runs at most once per offset
+    assert source.memo.misses == len(source.memo)
+    windowed = Source("1 + 2 * (3 - 4)", window=2)
+    assert expression.parse(windowed) == out
+    assert len(windowed.memo) < len(source.memo)
+
+def test_left_factoring():
+    optimized = deepcopy(unoptimized_expression)
+    AndOptimizer.optimize(optimized)
+    factored = deepcopy(optimized)
+    LeftFactorOptimizer.optimize(factored)
+    for text in ("1", "1 + 2", "1 - 2 * 3", "(1 + 2) - 3", "-5*4", "-5/5-", "a % (b - -c) * d", "1 +", ""):
+        source, factored_source = Source(text), Source(text)
+        assert factored.parse(factored_source) == optimized.parse(source)
+        # shared prefixes are parsed once, nothing is looked up again
+        assert factored_source.memo.hits == 0
+    source = Source("1 * 2")
+    optimized.parse(source)
+    assert source.memo.hits > 0
+
+def depth(parser, stack=frozenset()):
+    if parser in stack or not isinstance(parser, ParserNode): return 1
+    return 1 + max((depth(p, stack | {parser}) for p in parser.parsers), default=0)
+
+def test_action():
+    parseds = [(Token.INT, "int"), [1, 2], "a"]
+    assert Action(None, (0, 1))(parseds) == "int"
+    assert Action(Parameter, Action(None, (1, 0)), 2)(parseds) == Parameter(1, "a")
+    # splice the three results a sequence builds [1, 2] from in at index 1
+    spliced = Action(Parameter, (1, 1), 2).splice(1, 3, Action(None, 1))
+    assert spliced(["int", None, [1, 2], None, "a"]) == Parameter(2, "a")
+    assert Action(Parameter, (1, 1), 2).splice(1, 3, Action(list, 1)) is None
+
+def test_action_optimizer():
+    COMMA = TokenParser(Token.COMMA)
+    parameter = (INT.select(0, 1) & IDENTIFIER.select(0, 1)).build(Parameter, 0, 1)
+    parameters = (parameter & (COMMA & parameter).select(1).many()).build(lambda first, rest: [first, *rest], 0, 1)
+    optimized = deepcopy(parameters)
+    ActionOptimizer.optimize(optimized)
+    text = "int a, int b, int c"
+    assert optimized.parse(Source(text)) == parameters.parse(Source(text)) == [Parameter("int", "a"), Parameter("int", "b"), Parameter("int", "c")]
+    assert optimized.parse(Source("int a, int")) == [Parameter("int", "a")]
+    assert depth(optimized) < depth(parameters)
+
+def parse_calls(parser, text):
+    source = Source(text)
+    parsed = parser.parse(source)
+    return parsed, source.memo.hits + source.memo.misses
+
+def test_first_set_dispatch():
+    optimized = deepcopy(unoptimized_expression)
+    AndOptimizer.optimize(optimized)
+    predictive = deepcopy(optimized)
+    FirstSetOptimizer.optimize(predictive)
+    for text in ("1 + 2", "(1 + 2) - 3", "-5*4", "-5/5-", "a % (b - -c)", ""):
+        parsed, calls = parse_calls(optimized, text)
+        predicted, predicted_calls = parse_calls(predictive, text)
+        assert parsed == predicted
+        assert predicted_calls < calls
+
+class ResetDispatch(Visitor):
+    def visit(self, parser):
+        if isinstance(parser, OrParser): parser.dispatch = None
+
+def random_expression(rng: random.Random, depth=0):
+    if depth > 4 or rng.random() < 0.3:
+        return rng.choice(["1", "42", "a", "b_2"])
+    choice = rng.random()
+    if choice < 0.15: return f"({random_expression(rng, depth + 1)})"
+    if choice < 0.3: return f"{rng.choice('+-')} {random_expression(rng, depth + 1)}"
+    return f"{random_expression(rng, depth + 1)} {rng.choice('+-*/%')} {random_expression(rng, depth + 1)}"
+
+def test_expression_parser_equals_cascade():
+    cascade = deepcopy(unoptimized_expression)
+    AndOptimizer.optimize(cascade)
+    rng = random.Random(0)
+    for text in [*(random_expression(rng) for _ in range(200)), "-5/5-", "1 + - ", "(1", "- -a", ""]:
+        source, cascade_source = Source(text), Source(text)
+        assert expression.parse(source) == cascade.parse(cascade_source)
+        assert source.offset == cascade_source.offset
+    levels = [Token.STAR, Token.MINUS, Token.PLUS]
+    cascade, pratt = cascade_of(levels), pratt_of(levels)
+    AndOptimizer.optimize(cascade)
+    AndOptimizer.optimize(pratt)
+    for text in ("a * b - c + (d - e * f) * g", "a + b * c - d"):
+        assert pratt.parse(Source(text)) == cascade.parse(Source(text))
+
+def test_expression_parser_associativity():
+    operators = [Operator(Token.MINUS, 1, Associativity.LEFT, BinaryOp), Operator(Token.STAR, 2, Associativity.RIGHT, BinaryOp)]
+    left = ExpressionParser(primary, binary=operators)
+    one, two, three = (Immidiate(Integer, str(i)) for i in (1, 2, 3))
+    assert left.parse(Source("1 - 2 - 3")) == BinaryOp(BinaryOp(one, Token.MINUS, two), Token.MINUS, three)
+    assert left.parse(Source("1 * 2 * 3")) == BinaryOp(one, Token.STAR, BinaryOp(two, Token.STAR, three))
+    assert left.parse(Source("1 - 2 * 3 -")) == BinaryOp(one, Token.MINUS, BinaryOp(two, Token.STAR, three))
+
+def cascade_of(levels: list[Token]):
+    """recursive descent grammar with one precedence level per token, tightest first"""
+    expression = OrParser()
+    level = IDENTIFIER.bind(lambda x: Variable(x[1])) | (TokenParser(Token.LPAREN) & expression & TokenParser(Token.RPAREN)).bind(lambda x: x[1])
+    for token in levels:
+        next_level = OrParser()
+        next_level.parsers = ((level & TokenParser(token) & next_level).bind(lambda x: BinaryOp(x[0], x[1][0], x[2])) | level).parsers
+        level = next_level
+    expression.parsers = level.parsers
+    return expression
+
+def pratt_of(levels: list[Token]):
+    expression = ExpressionParser(binary=[Operator(token, -i, Associativity.RIGHT, BinaryOp) for i, token in enumerate(levels)])
+    expression.parsers = [IDENTIFIER.bind(lambda x: Variable(x[1])) | (TokenParser(Token.LPAREN) & expression & TokenParser(Token.RPAREN)).bind(lambda x: x[1])]
+    return expression
+
+corpus = [
+    HELLO,
+    "int f(int a, int b) { int c = a * b + 2; { c = c - 1; } return c; } int main() { int x; x = 3 % 2; ; return -x / (1+2); }",
+    "int main() { int a = 1; int b = a * 2 - 3 * 4 + 5 / 6 % 7 - -a; { int c = (a + b) * (a - b); a = c; } return a - b - 1; }",
+    "int a; int b = 2; a = b * - - 3;",
+    "float g() { return 1; } int h(float x) { { { ; } } }",
+    "int main() { return 1 +; }",
+    "-5/5- 3",
+    "",
+]
+
+def test_specialized_equals_combinators():
+    specialized = specialize(top)
+    for text in corpus:
+        source, specialized_source = Source(text), Source(text)
+        assert specialized.parse(specialized_source) == top.parse(source)
+        assert specialized_source.offset == source.offset
+
+def test_deferred_actions():
+    cascade = deepcopy(unoptimized_expression)
+    AndOptimizer.optimize(cascade)
+    rng = random.Random(1)
+    for parser, texts in ((top, corpus), (specialize(top), corpus), (cascade, [random_expression(rng) for _ in range(50)])):
+        for text in texts:
+            source, deferred = Source(text), Source(text, deferred=True)
+            parsed = parser.parse(deferred)
+            assert isinstance(parsed, Match)
+            assert resolve(parsed) == parser.parse(source)
+            assert deferred.offset == source.offset
+    # the operations span from their first token on
+    source = Source("b * 2 + - a * 3", deferred=True)
+    matches, spans = [expression.parse(source)], []
+    while matches:
+        if type(match:=matches.pop()) is Match:
+            if isinstance(match.parser, ExpressionParser): spans.append(source.span(match.start, match.end))
+            matches.extend(match.children)
+        elif type(match) in (list, tuple): matches.extend(match)
+    assert sorted(spans, key=len) == ["- a", "b * 2", "- a * 3", "b * 2 + - a * 3"]
+    # results nested deeper than the recursion limit
+    source = Source(nested(10_000), deferred=True)
+    assert resolve(top.iterate(source)).emit(Scope()) == top.iterate(Source(nested(10_000))).emit(Scope())
+
+def test_stream():
+    text = HELLO * 10 + "return 2 * 3;"
+    source = Source(text)
+    items = list(stream(source))
+    assert items == top.parse(Source(text)).body
+    # every committed item freed the memo behind it
+    assert source.memo.low == source.offset == len(source.tokens)
+    assert len(source.memo) <= 2
+    assert Arm64Program.build_stream(iter(items)).code == Arm64Program.build(top.parse(Source(text))).code
+
+def test_incremental():
+    rng = random.Random(2)
+    fragments = ["int ", "a", "1", " ", "+", "(", ")", ";", "{", "}", "return ", "=", ",", "-"]
+    for _ in range(200):
+        text = "\n".join(rng.choice(corpus) for _ in range(4))
+        document = Document(top_level, text)
+        for _ in range(5):
+            offset = rng.randint(0, len(text))
+            removed = min(rng.randint(0, 3), len(text) - offset)
+            inserted = "".join(rng.choice(fragments) for _ in range(rng.randint(0, 2)))
+            text = text[:offset] + inserted + text[offset + removed:]
+            document = document.edit(offset, removed, inserted)
+            source, full = Source(text), Document(top_level, text)
+            assert document.items == top_level.parse(source) and document.offset == source.offset
+            assert document.source == text and (document.starts, document.ends) == (full.starts, full.ends)
+    # only the edited function is parsed again
+    text = HELLO * 10
+    offset = text.index("10", 5 * len(HELLO))
+    document = Document(top_level, text).edit(offset, 2, "11")
+    assert document.parsed == 1 and document.items == top_level.parse(Source(text[:offset] + "11" + text[offset + 2:]))
+
+def test_mapped_source(tmp_path):
+    for index, text in enumerate(corpus):
+        (path:=tmp_path / f"{index}.c").write_text(text)
+        with Source(text) as source, MappedSource(str(path)) as mapped:
+            assert list(mapped.tokens) == list(source.tokens) and mapped.tokens.error == source.tokens.error
+            assert top.parse(mapped) == top.parse(source) and mapped.offset == source.offset
+            assert mapped.span(0) == source.span(0)
+        assert not text or mapped.source.closed
+
+def test_non_ascii(tmp_path):
+    # a mapped file and its text lex the same up to the first character that is not ASCII
+    for text, character in (("int main() { return 1; } é", "é"), ("int main() { return 1; }\u00a0", "\u00a0"), ("int main() { return 1; } \U0001f600", "\U0001f600")):
+        (path:=tmp_path / "source.c").write_text(text, encoding="utf-8")
+        with Source(text) as source, MappedSource(str(path)) as mapped:
+            compilation = compiler.compile_source(mapped)
+            assert compilation.diagnostics == compiler.compile_source(source).diagnostics
+            assert compilation.diagnostics == [f"line 1: unexpected character {character!r}"]
+    (path:=tmp_path / "latin1.c").write_bytes(b"int main() { return 1; } \xe9")
+    with MappedSource(str(path)) as mapped:
+        assert compiler.compile_source(mapped).diagnostics == ["line 1: unexpected character '\ufffd'"]
+
+def nested(depth: int) -> str:
+    return "int main() { int a = 1; return " + "(a + " * depth + "1" + ")" * depth + "; }"
+
+def test_iterate():
+    rng = random.Random(3)
+    for text in corpus + [random_expression(rng) for _ in range(50)]:
+        for deferred in (False, True):
+            source, iterated = Source(text, deferred=deferred), Source(text, deferred=deferred)
+            assert resolve(top.iterate(iterated)) == resolve(top.parse(source))
+            assert iterated.offset == source.offset and iterated.memo.misses == source.memo.misses
+    assert top.iterate(Source(nested(50))).emit(Scope()) == top.parse(Source(nested(50))).emit(Scope())
+    # far deeper than the recursion limit
+    source = Source(nested(10_000))
+    code = top.iterate(source).emit(Scope())
+    assert source.offset == len(source.tokens) and len(code) == 3 * 10_000 + 8
+
+def test_deep_input(tmp_path):
+    # everything that compiles parses nesting far deeper than the python stack goes
+    text = nested(2000)
+    compilation = compiler.compile_source(Source(text))
+    assert not compilation.diagnostics and compilation.assembly == str(Arm64Program.build(top.iterate(Source(text))))
+    (path:=tmp_path / "deep.c").write_text(text)
+    environment = {**os.environ, "CCOMPILER_AS": shlex.join(COPY), "CCOMPILER_LD": shlex.join(COPY)}
+    run = subprocess.run([sys.executable, "-m", "ccompiler", "-o", str(tmp_path / "deep"), str(path)],
+                         cwd=Path(__file__).parent.parent, env=environment, capture_output=True, text=True)
+    assert run.returncode == 0, run.stderr
+    assert (tmp_path / "deep.s").read_text() == compilation.assembly and (tmp_path / "deep").read_text() == compilation.assembly
+    # an error while emitting is reported like a diagnostic and leaves no assembly behind
+    run = subprocess.run([sys.executable, "-m", "ccompiler", "-s", "int main() { return b; }", "-o", str(tmp_path / "failed")],
+                         cwd=Path(__file__).parent.parent, env=environment, capture_output=True, text=True)
+    assert run.returncode == 1 and run.stderr == "error: Variable 'b' not found\n"
+    assert sorted(path.name for path in tmp_path.iterdir() if path.name.startswith("failed")) == ["failed"]
+    for flag in ("-p", "-v", "-i"):
+        run = subprocess.run([sys.executable, "-m", "ccompiler", "-c", flag, "-s", HELLO, "-o", str(tmp_path / "flags")],
+                             cwd=Path(__file__).parent.parent, env=environment, capture_output=True, text=True)
+        assert run.returncode == 2 and "can not be combined with -c/--cache" in run.stderr
+    assert not any(path.name.startswith("flags.") for path in tmp_path.iterdir())
+
+def test_profile():
+    cascade = deepcopy(unoptimized_expression)
+    AndOptimizer.optimize(cascade)
+    rng = random.Random(4)
+    for parser, texts in ((top, corpus), (specialize(top), corpus), (cascade, [random_expression(rng) for _ in range(20)])):
+        profile = Profile()
+        for text in texts:
+            source, profiled = Source(text), Source(text, profile=profile)
+            assert parser.parse(profiled) == parser.parse(source) and profiled.offset == source.offset
+        for stats in profile.stats.values():
+            assert stats.calls == stats.successes + stats.failures == stats.hits + stats.misses
+            assert 0 <= stats.exclusive <= stats.inclusive
+        assert json.loads(profile.json()).keys() == profile.stats.keys()
+        for line in profile.collapsed().splitlines():
+            stack, time = line.rsplit(" ", 1)
+            assert stack.split(";")[-1] in profile.stats and int(time) >= 0
+    assert {"EXP", "TERM", "FACT"} <= profile.stats.keys() and profile.stats["FACT"].hits > 0
+
+def test_trace(tmp_path, caplog):
+    for capacity in (50, 1 << 16):
+        trace = Trace(capacity, path=str(path:=tmp_path / f"{capacity}.trace"))
+        source = Source(HELLO * 3, trace=trace)
+        assert top.parse(source) == top.parse(Source(HELLO * 3))
+        written = trace.written
+        trace.close()
+        names, records = load(str(path))
+        assert len(records) == min(written, capacity) and records[-1][:4] == ("TOP", 0, len(source.tokens), 0)
+        if capacity > written:
+            statuses = [record[4] for record in records]
+            assert statuses.count(Status.PARSING) == statuses.count(Status.SUCCEEDED) + statuses.count(Status.FAILED)
+    caplog.set_level("DEBUG")
+    debug.show(str(path), source, parser="EXP", start=len(source.tokens) // 2)
+    # the source, then a parsing and a result line for the four expressions in the last one and a half functions
+    assert len(caplog.records) == 1 + 2 * 4
+    # a profile does not hide the named parsers from the trace
+    profile, trace = Profile(), Trace(1 << 16)
+    top.parse(Source(HELLO, profile=profile, trace=trace))
+    assert {"TOP", "EXP"} <= {trace.names[id] for id, *_ in RECORD.iter_unpack(trace.buffer[HEADER.size:HEADER.size + trace.written * RECORD.size])}
+    assert profile.stats["EXP"].calls > 0
+    trace.close()
+    with pytest.raises(ValueError):
+        trace.save()
+    trace.save(str(tmp_path / "memory.trace"))
+    names, records = load(str(tmp_path / "memory.trace"))
+    assert len(records) == trace.written and records[-1][0] == "TOP"
+
+def test_lazy_grammar(tmp_path, monkeypatch):
+    # importing the compiler does not build the grammar
+    code = "import sys, ccompiler.compiler as c; sys.exit('top' in vars(c) or 'ccompiler.optim' in sys.modules)"
+    assert subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent.parent).returncode == 0
+    built, loaded = compiler.load_grammar(str(tmp_path)), compiler.load_grammar(str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1 and built.keys() == loaded.keys()
+    assert built["top"] is not loaded["top"]
+    for text in corpus:
+        source, snapshot = Source(text), Source(text)
+        assert loaded["top"].parse(snapshot) == built["top"].parse(source) and snapshot.offset == source.offset
+    # a snapshot that was changed, or that others can write, is built again
+    builds, build = [], compiler.build_grammar
+    monkeypatch.setattr(compiler, "build_grammar", lambda: builds.append(1) or build())
+    (snapshot:=next(tmp_path.iterdir())).write_bytes(snapshot.read_bytes()[:-1] + b"\0")
+    compiler.load_grammar(str(tmp_path))
+    compiler.load_grammar(str(tmp_path))
+    snapshot.chmod(0o666)
+    compiler.load_grammar(str(tmp_path))
+    assert len(builds) == 2
+
+def test_server(tmp_path):
+    server = Server(str(socket:=tmp_path / "ccompiler.sock"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        (path:=tmp_path / "hello.c").write_text(HELLO)
+        messages = [{"string": HELLO * n} for n in range(1, 9)] + [{"path": str(path)}, {"string": "int main() { return 1 + ; }"}]
+        responses = [None] * len(messages)
+        def send(index: int):
+            responses[index] = request(messages[index], str(socket))
+        threads = [threading.Thread(target=send, args=(index,)) for index in range(len(messages)) for _ in range(3)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        for message, response in zip(messages, responses):
+            compilation = compiler.compile_source(Source(message.get("string") or HELLO))
+            assert response["assembly"] == compilation.assembly and response["diagnostics"] == compilation.diagnostics
+            assert response["timings"].keys() == {"parse", "emit"}
+        assert responses[-1]["diagnostics"] == ["line 1: could not parse from 'int' on"] and responses[-1]["assembly"] is None
+        # the client writes no assembly for a source with errors and fails
+        client = subprocess.run([sys.executable, "-m", "ccompiler.client", "--socket", str(socket), "-o", str(tmp_path / "broken"), "-s", "int main() { return 1; } @"],
+                                cwd=Path(__file__).parent.parent, capture_output=True, text=True)
+        assert client.returncode == 1 and client.stderr == "line 1: unexpected character '@'\n"
+        assert not (tmp_path / "broken.s").exists()
+        # a second server does not take the socket of one that is running
+        with pytest.raises(OSError, match="already listening"):
+            Server(str(socket))
+        assert request({"string": HELLO}, str(socket))["diagnostics"] == []
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not socket.exists()
+    # but it takes over the socket of one that did not shut down
+    with unix_socket(AF_UNIX, SOCK_STREAM) as stale:
+        stale.bind(str(socket))
+    with Server(str(socket)) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        assert request({"string": HELLO}, str(socket))["diagnostics"] == []
+        server.shutdown()
+
+class Count(Visitor):
+    def __init__(self):
+        self.visits = 0
+    def visit(self, parser):
+        self.visits += 1
+
+def test_concurrent_parse():
+    texts = [text * n for n in range(1, 4) for text in corpus] * 4
+    expected = [top.parse(Source(text)) for text in texts]
+    visits = Count()
+    top.traverse(visits)
+    switch = sys.getswitchinterval()
+    # switch threads as often as possible to interleave the parses
+    sys.setswitchinterval(1e-6)
+    try:
+        # traversing the grammar at the same time does not change it
+        traversals = [Count() for _ in range(4)]
+        threads = [threading.Thread(target=top.traverse, args=(count,)) for count in traversals]
+        for thread in threads: thread.start()
+        results = compiler.parse_all(texts, workers=8)
+        specialized = compiler.parse_all(map(Source, texts), parser=compiler.specialized(), workers=8)
+        for thread in threads: thread.join()
+    finally:
+        sys.setswitchinterval(switch)
+    assert results == expected and specialized == expected
+    assert all(count.visits == visits.visits for count in traversals)
+
+def test_batch(tmp_path):
+    texts = [HELLO, "int main() { return b; }", HELLO * 2, "int main() { int a = 1; return a; } @"]
+    paths = []
+    for index, text in enumerate(texts):
+        (path:=tmp_path / f"{index}.c").write_text(text)
+        paths.append(path.name)
+    (tmp_path / "manifest").write_text("# inputs\n" + "\n".join(paths) + "\nmissing.c\n")
+    units = compile_batch(manifest(str(tmp_path / "manifest")), str(tmp_path / "out"), workers=2)
+    assert [os.path.basename(unit.output) for unit in units] == ["0.s", "1.s", "2.s", "3.s", "missing.s"]
+    assert [unit.failed for unit in units] == [False, True, False, True, True]
+    for unit, text in zip(units, texts):
+        compilation = compiler.compile_source(Source(text))
+        assert unit.compilation.assembly == compilation.assembly and unit.compilation.diagnostics == compilation.diagnostics
+        assert Path(unit.output).read_text() == compilation.assembly if not unit.failed else not Path(unit.output).exists()
+    assert units[3].compilation.diagnostics == ["line 1: unexpected character '@'"]
+    assert units[-1].compilation.diagnostics[0].startswith("error:")
+    # files with the same name keep their directories apart
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "x.c").write_text(HELLO)
+    units = compile_batch([str(tmp_path / "a" / "x.c"), str(tmp_path / "b" / "x.c")], str(tmp_path / "out"), workers=1)
+    assert [unit.output for unit in units] == [str(tmp_path / "out" / "a" / "x.s"), str(tmp_path / "out" / "b" / "x.s")]
+    assert all(Path(unit.output).exists() for unit in units)
+    with pytest.raises(ValueError, match="both be compiled"):
+        compile_batch([str(tmp_path / "a" / "x.c"), str(tmp_path / "a" / ".." / "a" / "x.c")], str(tmp_path / "out"))
+
+# stands in for the assembler and the linker, copies its input to its output
+COPY = (sys.executable, "-c", "import shutil, sys; shutil.copy(sys.argv[1], sys.argv[2])", "{input}", "{output}")
+
+def test_pipeline(tmp_path):
+    texts = [HELLO, "int main() { return b; }", HELLO * 2]
+    paths = []
+    for index, text in enumerate(texts):
+        (path:=tmp_path / f"{index}.c").write_text(text)
+        paths.append(str(path))
+    pipeline = Pipeline(Toolchain(COPY, COPY), codegen=1, assemble=2, link=2)
+    builds = asyncio.run(pipeline.run(paths, str(tmp_path / "out")))
+    assert [build.path for build in builds] == paths
+    assert [build.error for build in builds] == [None, "codegen: code generation failed", None]
+    assert builds[1].diagnostics == ["error: Variable 'b' not found"]
+    for build in builds[::2]:
+        assert Path(build.output).read_text() == compiler.compile_source(Source(Path(build.path).read_text())).assembly
+    assert [len(stage.latencies) for stage in pipeline.stages] == [3, 2, 2]
+    assert all(len(stage.depths) == len(stage.latencies) for stage in pipeline.stages)
+    failing = Toolchain((sys.executable, "-c", "import sys; print('bad input'); sys.exit(3)"), COPY)
+    builds = asyncio.run(Pipeline(failing).run(paths[:1], str(tmp_path / "out")))
+    assert builds[0].error == f"assemble: {sys.executable} exited with 3: bad input"
+    # files with the same name keep their directories apart, as in a batch
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "x.c").write_text(HELLO)
+    sources = [str(tmp_path / "a" / "x.c"), str(tmp_path / "b" / "x.c")]
+    builds = asyncio.run(Pipeline(Toolchain(COPY, COPY)).run(sources, str(tmp_path / "out")))
+    assert [build.output for build in builds] == [str(tmp_path / "out" / "a" / "x"), str(tmp_path / "out" / "b" / "x")]
+    assert all(build.error is None and Path(build.output).exists() for build in builds)
+    with pytest.raises(ValueError, match="both be compiled"):
+        asyncio.run(Pipeline(Toolchain(COPY, COPY)).run([sources[0], str(tmp_path / "b" / ".." / "a" / "x.c")], str(tmp_path / "out")))
+    # the command line fails with the tool that failed
+    (tmp_path / "program.s").write_text("program")
+    assert assemble(str(tmp_path / "program"), Toolchain(COPY, failing.assembler)) == 3
+    assert assemble(str(tmp_path / "program"), Toolchain(COPY, COPY)) == 0 and (tmp_path / "program").read_text() == "program"
+    assert Toolchain.command(("-D{x}", "{input}", "-o{output}"), "a.s", "a.o") == ["-D{x}", "a.s", "-oa.o"]
+
+def test_function_cache(tmp_path):
+    functions = FunctionCache(str(tmp_path / "functions"))
+    texts = [*corpus, HELLO * 3 + corpus[1], "int x = 1; int main() { int a = x; { int c = a * 2; a = c; } return a - 1; } int y = 2; int f() { return x + y; }"]
+    for _ in range(2):
+        for text in texts:
+            compilation, cached = compiler.compile_source(Source(text)), compile_cached(Source(text), functions)
+            assert cached.assembly == compilation.assembly and cached.diagnostics == compilation.diagnostics
+    assert functions.hits > 0 and functions.evictions == 0
+    # an edit only compiles the function it changed again
+    hits, misses = functions.hits, functions.misses
+    text = texts[-1].replace("x + y", "y + x")
+    assert compile_cached(Source(text), functions).assembly == compiler.compile_source(Source(text)).assembly
+    assert (functions.hits - hits, functions.misses - misses) == (1, 1)
+    # the cache in another process gives the same output
+    functions = FunctionCache(functions.directory, size=2000)
+    assert compile_cached(Source(text), functions).assembly == compiler.compile_source(Source(text)).assembly
+    assert functions.misses == 0
+    for n in range(20):
+        compile_cached(Source(f"int f{n}() {{ return {n}; }}"), functions)
+    assert functions.evictions > 0 and functions.used <= functions.size
+    entries = list((tmp_path / "functions").iterdir())
+    assert sum(entry.stat().st_size for entry in entries) == functions.used and not any(entry.suffix == ".tmp" for entry in entries)
+
+def test_function_cache_writers(tmp_path):
+    # the threads of a server write to one cache
+    functions = FunctionCache(str(tmp_path / "functions"))
+    errors = []
+    def write(n):
+        try:
+            for _ in range(50): functions.put("same", [f"mov x0, #{n}"], n)
+        except Exception as error:
+            errors.append(error)
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert not errors and functions.get("same")[1] in range(8)
+    assert [entry.name for entry in (tmp_path / "functions").iterdir()] == ["same"]
+    # a cache that cannot be written still compiles
+    shutil.rmtree(functions.directory)
+    text = "int f() { return 1; } int main() { return f(); }"
+    assert compile_cached(Source(text), functions).assembly == compiler.compile_source(Source(text)).assembly
+
+def nodes(ast):
+    """every AST node under ast"""
+    stack = [ast]
+    while stack:
+        if isinstance(node:=stack.pop(), AstNode):
+            yield node
+            stack.extend(node if isinstance(node, list) else (getattr(node, field) for field in node.__dataclass_fields__))
+        elif isinstance(node, list):
+            stack.extend(node)
+
+def test_slotted_ast():
+    ast = top.parse(Source("int x = 1; int main() { int a = x; { int c = a * 2; a = c; } return a - 1; }" + HELLO))
+    assert not any(hasattr(node, "__dict__") for node in nodes(ast))
+    assert pickle.loads(pickle.dumps(ast)) == ast and deepcopy(ast) == ast
+    assert str(Arm64Program.build(pickle.loads(pickle.dumps(ast)))) == str(Arm64Program.build(ast))
+
+def test_serialize():
+    texts = [*corpus, HELLO * 3, "int a; float f(int a, float b) { return a; } int g() { { ; } }"]
+    # too deep to compare with ==, which recurses
+    ast = top.iterate(Source(nested(5000)))
+    data = serialize.dumps(ast)
+    assert serialize.dumps(serialize.loads(data)) == data
+    assert str(Arm64Program.build(serialize.loads(data))) == str(Arm64Program.build(ast))
+    for text in texts:
+        ast = top.parse(Source(text))
+        data = serialize.dumps(ast)
+        assert serialize.loads(data) == ast and serialize.load(io.BytesIO(data)) == ast
+        assert list(serialize.iterload(io.BytesIO(data))) == ast.body
+        reader = serialize.Reader(data)
+        assert list(reader) == ast.body and reader.load() == ast
+        for index, node in enumerate(ast.body):
+            assert reader.name(index) == (node.identifier if isinstance(node, Function) else None)
+    for value in (top.parse(Source(HELLO)).body[0].body[1], [1, -5, 2.5, True, None, (Token.IDENTIFIER, "x"), [], ()]):
+        assert serialize.loads(serialize.dumps(value)) == value
+    reader = serialize.Reader(serialize.dumps(top.parse(Source(texts[-1]))))
+    assert reader.function("f") == top.parse(Source(texts[-1])).body[1]
+    data = bytearray(serialize.dumps(top.parse(Source(HELLO))))
+    data[len(serialize.MAGIC)] += 1
+    with pytest.raises(ValueError):
+        serialize.loads(data)
+
+class CopyingScope(dict):
+    """the scope before it was chained, every child copies the variables of its parent"""
+    def __init__(self, variables=(), max_offset=None):
+        super().__init__(variables)
+        self.offset = 0
+        self.max_offset = max_offset or MaxOffset()
+    def create_var(self, identifier, size=8):
+        if identifier in self: return self[identifier]
+        self[identifier] = self.offset
+        self.offset += size
+        self.max_offset.check(self.offset)
+        return self[identifier]
+    def __getitem__(self, key):
+        if key not in self: raise Exception(f"Variable '{key}' not found")
+        return super().__getitem__(key)
+    def create_child(self):
+        return CopyingScope(self, self.max_offset)
+
+def deep_blocks(depth: int, locals: int = 10) -> str:
+    body = "".join("{ " + " ".join(f"int v{d}_{i} = v{max(d - 1, 0)}_{i} + {i};" for i in range(locals)) for d in range(depth))
+    return "int main() { int v0_0 = 0; " + body + "}" * depth + " return v0_0; }"
+
+def test_scope():
+    scope = Scope()
+    child = scope.create_child()
+    assert child.create_var("a") == 0 and child.create_var("b") == 8 and child.create_var("a") == 0
+    grandchild = child.create_child()
+    # a variable of an enclosing scope is not defined again
+    assert grandchild.create_var("a") == 0 and grandchild.create_var("c") == 0 and grandchild["c"] == 0
+    sibling = child.create_child()
+    assert "c" not in sibling and sibling["b"] == 8 and sibling.create_var("c") == 0
+    assert "c" not in child and dict(sibling.items()) == {"a": 0, "b": 8, "c": 0}
+    with pytest.raises(Exception, match="Variable 'd' not found"):
+        sibling["d"]
+    assert scope.max_offset is sibling.max_offset and scope.max_offset.value == 16
+    rng = random.Random(5)
+    def block(depth: int) -> str:
+        statements = rng.choices(["int a = 1;", "int b = 2;", "int c = a;", "a = 3;", "b = c;", "{}"], k=rng.randrange(5))
+        if depth < 6: statements += [block(depth + 1) for _ in range(rng.randrange(3))]
+        rng.shuffle(statements)
+        return "{ " + " ".join(statements) + " }"
+    texts = [deep_blocks(30, 3), *(f"int main() {block(0)[:-1]} return 0; }}" for _ in range(300))]
+    compared = 0
+    for text in texts:
+        ast = top.iterate(source:=Source(text))
+        if source.offset < len(source.tokens): continue
+        compared += 1
+        code = []
+        for scope in (Scope(), CopyingScope()):
+            try:
+                code.append(ast.emit(scope))
+            except Exception as error:
+                code.append(str(error))
+        assert code[0] == code[1]
+    assert compared > 20
+
+def test_write_program():
+    texts = [HELLO * 3, "int x = 1; int main() { int a = x; { int c = a * 2; a = c; } return a - 1; } int y = 2;", "", deep_blocks(20, 2)]
+    for text in texts:
+        ast = top.iterate(Source(text))
+        file = io.StringIO()
+        Arm64Program.write(ast, file)
+        assert file.getvalue() == str(Arm64Program.build(ast))
+        file = io.StringIO()
+        Arm64Program.write_stream(stream(Source(text)), file)
+        assert file.getvalue() == str(Arm64Program.build(ast))
+    file = io.StringIO()
+    writer = CodeWriter(file)
+    writer.CHUNK = 2
+    writer.extend(["a", None, "c"])
+    writer.spill()
+    assert file.getvalue() == "a" and len(writer) == 3
+    writer.append(None)
+    writer[1] = "b"
+    assert file.getvalue() == "a\nb\nc" and len(writer) == 4
+    writer.append("e")
+    writer[3] = "d"
+    writer.append("f")
+    writer.flush()
+    assert file.getvalue() == "a\nb\nc\nd\ne\nf" and not writer.lines
+
+def wrap(value: int) -> int:
+    return (value + (1 << 31)) % (1 << 32) - (1 << 31)
+
+def divide(a: int, b: int) -> int:
+    # sdiv truncates and gives 0 for a division by zero
+    return 0 if b == 0 else abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+
+ARITHMETIC = {"add": lambda a, b: a + b, "sub": lambda a, b: a - b, "mul": lambda a, b: a * b, "sdiv": divide}
+
+def run(program: Arm64Program) -> int:
+    """simulate the instructions the code generators use, from _main to its ret"""
+    lines = str(program).splitlines()
+    registers = {"sp": 1 << 16}
+    memory = {}
+    def value(operand: str) -> int:
+        return int(operand[1:]) if operand.startswith("#") else registers[operand]
+    pc = lines.index("_main:") + 1
+    while True:
+        op, _, rest = lines[pc].partition(" ")
+        args = rest.replace("[", "").replace("]", "").replace(" ", "").split(",")
+        pc += 1
+        if op == "ret": return registers["w0"]
+        elif op == "ldr": registers[args[0]] = memory.get(registers["sp"] + value(args[2]), 0)
+        elif op == "str": memory[registers["sp"] + value(args[2])] = registers[args[0]]
+        elif op == "mov": registers[args[0]] = value(args[1])
+        elif op == "neg": registers[args[0]] = wrap(-value(args[1]))
+        elif op == "msub": registers[args[0]] = wrap(value(args[3]) - value(args[1]) * value(args[2]))
+        else: registers[args[0]] = wrap(ARITHMETIC[op](value(args[1]), value(args[2])))
+
+def random_program(rng: random.Random) -> str:
+    # the direct emitter keeps the left operand in w9 while it emits the right one, so
+    # the right operands are never operations themselves, the operators are right associative
+    names = []
+    def operand():
+        return rng.choice(names) if names and rng.random() < 0.5 else str(rng.randint(0, 100))
+    def expression():
+        text = operand()
+        for _ in range(rng.randint(0, 4)):
+            text = f"({text}) {rng.choice('+-*/%')} {operand()}"
+        return text
+    def statements(depth: int) -> list[str]:
+        lines, visible = [], len(names)
+        for _ in range(rng.randint(1, 5)):
+            if (choice:=rng.random()) < 0.4 or not names:
+                names.append(name:=f"v{len(names)}")
+                lines.append(f"int {name} = {expression()};")
+            elif choice < 0.8: lines.append(f"{rng.choice(names)} = {expression()};")
+            elif depth < 3: lines.append(f"{{ {' '.join(statements(depth + 1))} }}")
+        if depth: del names[visible:]
+        return lines
+    return f"int main() {{ {' '.join(statements(0))} return {expression()}; }}"
+
+def test_ir():
+    rng = random.Random(25)
+    for _ in range(200):
+        ast = top.parse(Source(text:=random_program(rng)))
+        expected = run(Arm64Program.build(ast))
+        routines = ir.lower(ast)
+        for routine in routines:
+            routine.validate()
+        assert run(ir.generate_program(routines)) == expected, text
+        # the registers that don't fit are spilled
+        assert run(ir.build(ast, ("w8", "w9"))) == expected, text
+    # the direct emitter gets these wrong, or can't emit them
+    assert run(ir.build(top.parse(Source("int main() { return 1 - (2 - 3); }")))) == 2
+    assert run(ir.build(top.parse(Source("int main() { int a = -7; return a % 3 * - - 2 + 40 / -a; }")))) == -1 + 5
+    assert run(ir.build(top.parse(Source("int main() { int a = 1; }")))) == 0
+    routines = ir.lower(top.parse(Source("int x = 2; int main() { return x * 3; x = 1; } ;")))
+    assert ir.dump(routines) == "\n".join([
+        "function <top level> (1 registers, 1 slots)", "  b0:", "    r0 = const 2", "    store s0, r0",
+        "function main (4 registers, 1 slots)", "  b0:", "    r0 = load s0", "    r1 = const 3", "    r2 = mul r0, r1", "    ret r2",
+        "  b1:", "    r3 = const 1", "    store s0, r3",
+    ])
+    # returns between the functions are lowered like the direct emitter does
+    for text in ("return 1;", "int main() { return 1; } return 2; int x = 3;"):
+        routines = ir.lower(top.parse(Source(text)))
+        for routine in routines:
+            routine.validate()
+        assert routines[-1].instruction(1) == "ret r0" and str(ir.build(top.parse(Source(text)))).count("ret") == text.count("return")
+    routine = ir.lower(top.parse(Source("int main() { return 1 + 2; }")))[0]
+    routine.b[2] = 4
+    with pytest.raises(ValueError, match="r4 is used but not defined"):
+        routine.validate()
+    routine = ir.Routine("f")
+    routine.emit(ir.Op.CONST, 1)
+    with pytest.raises(ValueError, match="end of the function is reachable"):
+        routine.validate()
+    with pytest.raises(Exception, match="Variable 'y' not found"):
+        ir.lower(top.parse(Source("int main() { return y; }")))
+
 def test_parameter_list():
     parameter_list.parse(Source("")) == []
     parameter_list.parse(Source("int a")) == [Parameter(Token.INT, "a")]
@@ -62,4 +807,237 @@ if __name__ == "__main__":
     
     NUMBER = 100
     te = min(repeat('test_expression_parser()', number=NUMBER, globals=globals()))
-    print(f"Expression parser: {te * (1_000_000 / NUMBER):.2f} µs")
\ No newline at end of file
+    print(f"Expression parser: {te * (1_000_000 / NUMBER):.2f} µs")
+    
+    text = HELLO * 1000
+    t = min(repeat(lambda: lex(text), number=1, repeat=3))
+    print(f"Lexer: {len(lex(text)) / t / 1000:.0f} tokens/ms")
+    
+    text = HELLO * 100
+    unpredictive = deepcopy(top)
+    unpredictive.traverse(ResetDispatch())
+    for name, parser in (("Ordered choice", unpredictive), ("Predictive dispatch", top)):
+        t = min(repeat(lambda: parser.parse(Source(text)), number=1, repeat=3))
+        calls = parse_calls(parser, text)[1]
+        print(f"{name}: {calls / len(lex(text)):.2f} parse calls per token, {t * 1000:.2f} ms")
+    
+    # the rest of the corpus does not parse to the end
+    text = "\n".join(corpus[:5]) * 100
+    specialized = specialize(top)
+    t_top = min(repeat("top.parse(source)", "source = Source(text)", number=1, repeat=5, globals=globals()))
+    t_specialized = min(repeat("specialized.parse(source)", "source = Source(text)", number=1, repeat=5, globals=globals()))
+    print(f"Combinators: {t_top * 1000:.2f} ms, specialized: {t_specialized * 1000:.2f} ms ({t_top / t_specialized:.1f}x)")
+    
+    cascade = deepcopy(unoptimized_expression)
+    for optimizer in (AndOptimizer, FirstSetOptimizer): optimizer.optimize(cascade)
+    text = " + ".join(f"(a * {i} - -b) % c" for i in range(30))
+    for name, parser in (("cascade", cascade), ("expression", expression)):
+        for deferred in (False, True):
+            t = min(repeat(lambda: resolve(parser.parse(Source(text, deferred=deferred))), number=10, repeat=3)) / 10
+            source = Source(text, deferred=deferred)
+            tracemalloc.start()
+            parsed = resolve(parser.parse(source))
+            # objects the parse allocated that the memo and the result still hold on to
+            blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{'Deferred' if deferred else 'Eager'} actions on {name}: {t * 1000:.2f} ms, {blocks} allocations, {peak / 1024:.0f} KiB peak")
+    
+    symbols = {Token.PERCENT: "%", Token.SLASH: "/", Token.STAR: "*", Token.MINUS: "-", Token.PLUS: "+"}
+    for n in range(1, len(symbols) + 1):
+        levels = list(symbols)[:n]
+        text = " ".join(f"a {symbols[levels[i % n]]}" for i in range(30)) + " (a)"
+        for name, parser in (("Cascade", cascade_of(levels)), ("ExpressionParser", pratt_of(levels))):
+            for optimizer in (AndOptimizer, LeftFactorOptimizer, OrOptimizer, FirstSetOptimizer): optimizer.optimize(parser)
+            t = min(repeat(lambda: parser.parse(Source(text)), number=10, repeat=3)) / 10
+            print(f"{name} with {n} precedence levels: {parse_calls(parser, text)[1] / len(lex(text)):.2f} parse calls per token, {t * 1000:.2f} ms")
+    
+    for n in (10, 100, 1000):
+        text = " + ".join(["(1 * 2 - 3)"] * n)
+        t = min(repeat(lambda: expression.parse(Source(text)), number=1, repeat=3))
+        source = Source(text)
+        expression.parse(source)
+        print(f"Expression of {len(text)} chars: {t * 1000:.2f} ms, {source.memo}")
+    
+    text = HELLO * 2000
+    for name, parse in (("Whole file", lambda source: top.parse(source).body), ("Streaming", lambda source: sum(1 for _ in stream(source)))):
+        t = min(repeat(lambda: parse(Source(text)), number=1, repeat=3))
+        source = Source(text)
+        tracemalloc.start()
+        parse(source)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name} parse of {len(text)} chars: {t * 1000:.2f} ms, {peak / 1024:.0f} KiB peak on top of the tokens")
+    
+    text = HELLO * 2000
+    document = Document(top_level, text)
+    offset = text.index("10", len(text) // 2)
+    t_full = min(repeat(lambda: top_level.parse(Source(text[:offset] + "11" + text[offset + 2:])), number=1, repeat=3))
+    t_edit = min(repeat(lambda: document.edit(offset, 2, "11"), number=1, repeat=3))
+    print(f"One character edit in {len(text)} chars: full reparse {t_full * 1000:.2f} ms, incremental {t_edit * 1000:.2f} ms")
+    
+    with tempfile.NamedTemporaryFile("w", suffix=".c") as file:
+        file.write(HELLO * 20000)
+        file.flush()
+        for name, open_source in (("str", lambda: Source(open(file.name).read())), ("mmap", lambda: MappedSource(file.name))):
+            t_lex = min(repeat(open_source, number=1, repeat=3))
+            t = min(repeat(lambda: sum(1 for _ in stream(open_source())), number=1, repeat=3))
+            tracemalloc.start()
+            source = open_source()
+            lexed = tracemalloc.get_traced_memory()[1]
+            sum(1 for _ in stream(source))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del source
+            print(f"{name} source of {len(HELLO) * 20000 / 1024:.0f} KiB: lexed in {t_lex * 1000:.0f} ms with {lexed / 1024:.0f} KiB peak, streamed in {t * 1000:.0f} ms with {peak / 1024:.0f} KiB peak")
+    
+    text = nested(10_000)
+    t_parse = min(repeat(lambda: top.iterate(Source(text)), number=1, repeat=3))
+    ast = top.iterate(Source(text))
+    t_emit = min(repeat(lambda: ast.emit(Scope()), number=1, repeat=3))
+    print(f"Expression nested 10000 deep: iterative parse {t_parse * 1000:.2f} ms, iterative emit {t_emit * 1000:.2f} ms")
+    
+    text = HELLO * 300
+    for name, profile in (("Without profile", lambda: None), ("With profile", Profile)):
+        t = min(repeat(lambda: top.parse(Source(text, profile=profile())), number=1, repeat=5))
+        print(f"{name}: {t * 1000:.2f} ms")
+    
+    text = HELLO * 300
+    for name, trace in (("Without trace", lambda: None), ("With trace", Trace)):
+        t = min(repeat(lambda: top.parse(Source(text, trace=trace())), number=1, repeat=5))
+        print(f"{name}: {t * 1000:.2f} ms")
+    
+    for code in ("pass", "import ccompiler.compiler", "import ccompiler.compiler as c; c.grammar()", "import ccompiler.compiler as c; c.build_grammar()"):
+        t = min(repeat(lambda: subprocess.run([sys.executable, "-c", code], check=True), number=1, repeat=20))
+        print(f"{code}: {t * 1000:.1f} ms")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        with open(path:=f"{directory}/hello.c", "w") as file:
+            file.write(HELLO * 100)
+        server = Server(socket:=f"{directory}/ccompiler.sock")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        for name, code in (
+                ("Cold process", f"from ccompiler.server import compile_request; compile_request({{'path': {path!r}}})"),
+                ("Client of a warm server", f"from ccompiler.client import request; request({{'path': {path!r}}}, {socket!r})")):
+            t = min(repeat(lambda: subprocess.run([sys.executable, "-c", code], check=True), number=1, repeat=10))
+            print(f"{name}: {t * 1000:.1f} ms per file")
+        t = min(repeat(lambda: request({"path": path}, socket), number=1, repeat=10))
+        print(f"Request to a warm server: {t * 1000:.1f} ms per file")
+        server.shutdown()
+        server.server_close()
+    
+    texts = [HELLO * 100] * 32
+    print(f"GIL enabled: {getattr(sys, '_is_gil_enabled', lambda: True)()}")
+    for workers in (1, 2, 4, 8):
+        t = min(repeat(lambda: compiler.parse_all(texts, workers=workers), number=1, repeat=3))
+        print(f"Parse of {len(texts)} sources on {workers} threads: {t * 1000:.0f} ms")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for index in range(64):
+            with open(path:=f"{directory}/{index}.c", "w") as file:
+                file.write(HELLO * 100)
+            paths.append(path)
+        print(f"Cores: {os.cpu_count()}")
+        for workers in (1, 2, 4, 8):
+            t = min(repeat(lambda: compile_batch(paths, workers=workers), number=1, repeat=3))
+            print(f"Batch of {len(paths)} files on {workers} processes: {t * 1000:.0f} ms, {len(paths) / t:.0f} files/s")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for index in range(16):
+            with open(path:=f"{directory}/{index}.c", "w") as file:
+                file.write(HELLO * 300)
+            paths.append(path)
+        # a toolchain that spends most of its time waiting, the sandbox may have one core only
+        slow = (COPY[0], "-c", "import shutil, sys, time; time.sleep(0.05); shutil.copy(sys.argv[1], sys.argv[2])", *COPY[3:])
+        toolchain = Toolchain(slow, slow)
+        def sequential():
+            for path in paths:
+                output = path[:-2]
+                with open(f"{output}.s", "w") as file:
+                    file.write(compiler.compile_source(MappedSource(path)).assembly)
+                subprocess.run(toolchain.command(toolchain.assembler, f"{output}.s", f"{output}.o"), check=True)
+                subprocess.run(toolchain.command(toolchain.linker, f"{output}.o", output), check=True)
+        t = min(repeat(sequential, number=1, repeat=3))
+        print(f"Sequential build of {len(paths)} files: {t * 1000:.0f} ms")
+        for jobs in (1, 4):
+            pipeline = Pipeline(toolchain, 1, jobs, jobs)
+            start = perf_counter()
+            asyncio.run(pipeline.run(paths))
+            print(f"Pipelined build of {len(paths)} files, {jobs} toolchain jobs per stage: {(perf_counter() - start) * 1000:.0f} ms")
+            for stage in pipeline.stages:
+                print(f"    {stage}")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        text = "\n".join(f"int f{n}() {{ int a = {n}; int b = a * {n} + 1; {{ int c = b % 7; b = c; }} return b - a; }}" for n in range(1000))
+        edited = text.replace("int b = a * 500", "int b = a * 501")
+        functions = FunctionCache(f"{directory}/functions")
+        t_plain = min(repeat(lambda: compiler.compile_source(Source(text)), number=1, repeat=3))
+        start = perf_counter()
+        compile_cached(Source(text), functions)
+        t_cold = perf_counter() - start
+        t_warm = min(repeat(lambda: compile_cached(Source(text), functions), number=1, repeat=3))
+        start = perf_counter()
+        compile_cached(Source(edited), functions)
+        t_edit = perf_counter() - start
+        print(f"1000 functions: uncached {t_plain * 1000:.0f} ms, cold cache {t_cold * 1000:.0f} ms, warm cache {t_warm * 1000:.0f} ms, one function edited {t_edit * 1000:.0f} ms")
+    
+    text = "\n".join(f"int f{n}() {{ int a = {n}; int b = a * {n} + 1; {{ int c = b % 7; b = c; }} return b - a; }}" for n in range(5000))
+    source = Source(text)
+    tracemalloc.start()
+    ast = top.parse(source)
+    del source
+    # what is left is the tree
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    count = len(list(nodes(ast)))
+    t_build = min(repeat(lambda: top.parse(Source(text)), number=1, repeat=3))
+    t_walk = min(repeat(lambda: ast.emit(Scope()), number=1, repeat=3))
+    print(f"AST of {count} nodes: {size / count:.0f} bytes per node, built in {t_build * 1000:.0f} ms, emitted in {t_walk * 1000:.0f} ms")
+    
+    text = "\n".join(f"int f{n}() {{ int a = {n}; int b = a * {n} + 1; {{ int c = b % 7; b = c; }} return b - a; }}" for n in range(5000))
+    ast = top.parse(Source(text))
+    data = {"pickle": pickle.dumps(ast, protocol=pickle.HIGHEST_PROTOCOL), "serialize": serialize.dumps(ast)}
+    for name, dumps, loads in (("pickle", lambda: pickle.dumps(ast, protocol=pickle.HIGHEST_PROTOCOL), lambda: pickle.loads(data["pickle"])),
+                               ("serialize", lambda: serialize.dumps(ast), lambda: serialize.loads(data["serialize"]))):
+        t_dump = min(repeat(dumps, number=1, repeat=3))
+        t_load = min(repeat(loads, number=1, repeat=3))
+        print(f"{name} of 5000 functions: {len(data[name]) / 1024:.0f} KiB, dumped in {t_dump * 1000:.0f} ms, loaded in {t_load * 1000:.0f} ms")
+    t = min(repeat(lambda: serialize.Reader(data["serialize"]).function("f4999"), number=1, repeat=3))
+    print(f"Lazy load of the last function: {t * 1000:.1f} ms")
+    
+    ast = top.iterate(Source(deep_blocks(1000)))
+    for name, scope in (("Chained scopes", Scope), ("Copying scopes", CopyingScope)):
+        t = min(repeat(lambda: ast.emit(scope()), number=1, repeat=3))
+        print(f"{name}, blocks nested 1000 deep with 10 locals each: emitted in {t * 1000:.0f} ms")
+    
+    text = "\n".join(f"int f{n}() {{ int a = {n}; int b = a * {n} + 1; {{ int c = b % 7; b = c; }} return b - a; }}" for n in range(20000))
+    ast = top.parse(Source(text))
+    with tempfile.TemporaryDirectory() as directory:
+        def joined():
+            with open(f"{directory}/joined.s", "w") as file:
+                file.write(str(Arm64Program.build(ast)))
+        def written():
+            with open(f"{directory}/written.s", "w") as file:
+                Arm64Program.write(ast, file)
+        for name, emit in (("Joined program", joined), ("Program written while emitting", written)):
+            t = min(repeat(emit, number=1, repeat=3))
+            tracemalloc.start()
+            emit()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{name} of 20000 functions: {t * 1000:.0f} ms, {peak / 1024:.0f} KiB peak")
+        assert Path(f"{directory}/joined.s").read_bytes() == Path(f"{directory}/written.s").read_bytes()
+    
+    rng = random.Random(25)
+    text = "\n".join(random_program(rng).replace("main", f"f{n}", 1) for n in range(2000)) + "\nint main() { return 0; }"
+    ast = top.parse(Source(text))
+    routines = ir.lower(ast)
+    for name, build in (("Direct emitter", lambda: Arm64Program.build(ast)), ("Lowered to the IR", lambda: ir.lower(ast)),
+                        ("IR to instructions", lambda: ir.generate_program(routines)), ("Through the IR", lambda: ir.build(ast))):
+        t = min(repeat(build, number=1, repeat=3))
+        print(f"{name}, 2000 random functions: {t * 1000:.0f} ms")
+    for name, program in (("direct emitter", Arm64Program.build(ast)), ("IR", ir.build(ast))):
+        print(f"Instructions of the {name}: {len(program.code)}")
+    print(f"IR: {sum(len(routine) for routine in routines)} operations, {sum(routine.registers for routine in routines)} virtual registers")